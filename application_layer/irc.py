@@ -1,12 +1,67 @@
 import re
 import asyncio
-from threading import Lock
+import logging
+from bisect import bisect_left, insort
+
+from utils.irc import MAX_LINE_LENGTH, LineBuffer, LineTooLong, parse_message
+from utils.ratelimit import TokenBucket
+from utils.metrics import REGISTRY
+from utils.trace import boundary
+
+FLOOD_RATE = 4              # Commands per second a client may sustain
+FLOOD_BURST = 10            # Commands a client may send back to back
+RECVQ_BYTES = 8 * 1024      # Input waiting to be processed before disconnecting
+SENDQ_BYTES = 64 * 1024     # Output waiting for the TCP window before disconnecting
+SENDQ_LINES = 1000
+THROTTLE_MIN_DELAY = 0.001  # Seconds a throttled client waits at least, so the clock moves on
+
+logger = logging.getLogger(__name__)
+
+unknown_commands = REGISTRY.counter('irc_commands_total', 'Commands received', command='unknown')
+messages_sent = REGISTRY.counter('irc_messages_sent_total', 'Lines sent to clients by broadcasts')
+throttled = REGISTRY.counter('irc_throttled_total', 'Times a client was slowed down for flooding')
+evicted = REGISTRY.counter('irc_evicted_total', 'Clients disconnected for flooding or not reading')
 
 class IRCServer:
-    def __init__(self, tcp_server):
+    def __init__(self, tcp_server, flood_rate=FLOOD_RATE, flood_burst=FLOOD_BURST,
+                 recvq_bytes=RECVQ_BYTES, sendq_bytes=SENDQ_BYTES, sendq_lines=SENDQ_LINES):
+        """
+        Instantiate the IRC server over a transport layer. Clients sending
+        commands faster than flood_rate per second (after a burst of
+        flood_burst) are slowed down, and disconnected once more than
+        recvq_bytes wait to be processed. Clients not reading their output
+        are disconnected when the data queued on their connection goes
+        over sendq_bytes or sendq_lines.
+        """
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.recvq_bytes = recvq_bytes
+        self.sendq_bytes = sendq_bytes
+        self.sendq_lines = sendq_lines
+        self.throttled_count = 0
+        self.evicted_count = 0
         self._connections = {}
         self._channels = {}
-        self._datamutex = Lock()
+        # (connection, reason) of evicted clients whose exit is not processed yet
+        self._evictions = []
+        self._evicting = False
+        # command: (handler, number of parameters it takes)
+        self._commands = {
+            b'PING': (self.process_ping, 1),
+            b'NICK': (self.process_nick, 1),
+            b'PRIVMSG': (self.process_privmsg, 2),
+            b'JOIN': (self.process_join, 1),
+            b'PART': (self.process_part, 1),
+            b'STATS': (self.process_stats, 1),
+        }
+        self._command_counts = {
+            command: REGISTRY.counter('irc_commands_total', 'Commands received', command=command.decode())
+            for command in self._commands
+        }
+        REGISTRY.gauge('irc_clients', 'Clients with a nickname',
+                       function=lambda server: len(server._connections), owner=self)
+        REGISTRY.gauge('irc_channels', 'Channels with members',
+                       function=lambda server: len(server._channels), owner=self)
 
         tcp_server.register_accepted_connections_monitor(self.accepted_connection)
 
@@ -16,211 +71,277 @@ class IRCServer:
     def data_received(self, connection, data):
         if data == b'':
             return self.connection_left(connection)
-        
-        client_ip = connection.connection_id[0]
-        client_port = connection.connection_id[1]
-
-        connection._residue = connection._residue + data
+        if connection._gone:
+            return
 
-        message, separator, rest = connection._residue.partition(b'\r\n')
-        while separator != b'':
-            print(f'Message received from {client_ip}:{client_port}: {message}')
+        connection._lines.feed(data)
+        if connection._lines.pending() > self.recvq_bytes:
+            return self.evict(connection, b'Excess Flood')
+        if connection._throttled is None:
+            self.process_lines(connection)
+
+    def process_lines(self, connection):
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        while not connection._gone and connection._throttled is None:
+            if connection._lines.has_line() and not connection._flood.consume():
+                # Over the command rate: the remaining lines wait in the buffer
+                self.throttled_count += 1
+                throttled.inc()
+                delay = max(connection._flood.delay(), THROTTLE_MIN_DELAY)
+                connection._throttled = asyncio.get_event_loop().call_later(
+                    delay, self._resume_lines, connection)
+                return
+
+            try:
+                message = connection._lines.next_line()
+            except LineTooLong:
+                connection.send(b':server 417 %s :Input line was too long\r\n' % connection._nickname)
+                continue
+            if message is None:
+                break
+
+            if debug:
+                logger.debug('Message received from %s:%d: %r',
+                             connection.connection_id[0], connection.connection_id[1], message)
 
             self.interpret_message(connection, message)
 
-            connection._residue = rest
-            message, separator, rest = connection._residue.partition(b'\r\n')
+    def _resume_lines(self, connection):
+        connection._throttled = None
+        self.process_lines(connection)
 
     def accepted_connection(self, connection):
-        client_ip = connection.connection_id[0]
-        client_port = connection.connection_id[1]
-        print(f'New connection from {client_ip}:{client_port}')
+        logger.info('New connection from %s:%d', connection.connection_id[0], connection.connection_id[1])
 
-        connection._residue = b''
+        self.init_connection(connection)
+        connection.register_receiver(self.data_received)
+
+    def init_connection(self, connection):
+        """
+        Attach the IRC state of a client to its connection.
+        """
+        connection._lines = LineBuffer()
         connection._nickname = b'*'
+        connection._nick_key = None
         connection._channels = set()
-        connection.register_receiver(self.data_received)
+        connection._flood = TokenBucket(self.flood_rate, self.flood_burst)
+        connection._throttled = None
+        connection._gone = False
 
     def connection_left(self, connection):
+        if connection._gone:
+            return
+        self._forget(connection)
         self.process_exit(connection)
-
-        client_ip = connection.connection_id[0]
-        client_port = connection.connection_id[1]
-        print(f'Connection closed with {client_ip}:{client_port}')
+        logger.info('Connection closed with %s:%d', connection.connection_id[0], connection.connection_id[1])
 
         connection.close()
 
+    def evict(self, connection, reason):
+        """
+        Disconnect a client at once, telling it why with an ERROR line.
+        Clients evicted while the exit of another is processed (by its QUIT
+        broadcast) are processed afterwards, by the outermost call.
+        """
+        if connection._gone:
+            return
+        self._forget(connection)
+        self.evicted_count += 1
+        evicted.inc()
+        logger.warning('Evicting %s:%d: %s', connection.connection_id[0], connection.connection_id[1],
+                       reason.decode(errors='replace'))
+
+        self._evictions.append((connection, reason))
+        if self._evicting:
+            return
+        self._evicting = True
+        try:
+            while self._evictions:
+                connection, reason = self._evictions.pop(0)
+                self.process_exit(connection, reason)
+                connection.abort(b'ERROR :Closing Link: %s (%s)\r\n' % (connection._nickname, reason))
+        finally:
+            self._evicting = False
+
+    def _forget(self, connection):
+        connection._gone = True
+        if connection._throttled is not None:
+            connection._throttled.cancel()
+            connection._throttled = None
+
+    def _over_sendq(self, connection):
+        queued_bytes, queued_segments = connection.pending_output()
+        return queued_bytes > self.sendq_bytes or queued_segments > self.sendq_lines
+
     def validate_nickname(self, nickname):
         return re.match(br'^[a-zA-Z][a-zA-Z0-9_-]*$', nickname) is not None
     
+    @boundary('irc')
     def interpret_message(self, connection, msg):
-        fields = msg.strip(b' \r\n').split(b' ')
-        if len(fields) < 2: return
-
-        verb = fields[0].upper()
-        if verb == b'PING':
-            self.process_ping(connection, b' '.join(fields[1:]))
-        elif verb == b'NICK':
-            self.process_nick(connection, fields[1])
-        elif verb == b'PRIVMSG' and len(fields) >= 3:
-            if fields[1][0:1] == b'#':
-                self.process_channel_privmsg(connection, fields[1], b' '.join(fields[2:]))
-            else:
-                self.process_personal_privmsg(connection, fields[1], b' '.join(fields[2:]))
-        elif verb == b'JOIN' and connection._nickname != b'*':
-            self.process_join(connection, fields[1])
-        elif verb == b'PART':
-            self.process_part(connection, fields[1])
+        parsed = parse_message(msg)
+        if parsed is None: return
+
+        _, command, params = parsed
+        handler = self._commands.get(command)
+        if handler is None:
+            unknown_commands.inc()
+            return
+
+        self._command_counts[command].inc()
+        process, param_count = handler
+        if len(params) < param_count: return
+        process(connection, *params[:param_count])
 
     def process_ping(self, connection, payload):
         connection.send(b':server PONG server :%s\r\n' % payload)
     
+    def process_stats(self, connection, query):
+        """
+        STATS m lists how many times each command was used, STATS s dumps
+        the metrics of the whole stack, one Prometheus sample per line.
+        """
+        query = query[:1].lower()
+        nickname = connection._nickname
+        # Sent at once, not as one segment per line
+        reply = bytearray()
+        if query == b'm':
+            for command, counter in self._command_counts.items():
+                reply += b':server 212 %s %s %d\r\n' % (nickname, command, counter.get())
+        elif query == b's':
+            for line in REGISTRY.prometheus().splitlines():
+                if not line.startswith('#'):
+                    reply += b':server 249 %s :%s\r\n' % (nickname, line.encode())
+        reply += b':server 219 %s %s :End of /STATS report\r\n' % (nickname, query)
+        connection.send(bytes(reply))
+
     def process_nick(self, connection, nickname):
         if not self.validate_nickname(nickname):
-            connection.enviar(b':server 432 %s %s :Erroneous nickname\r\n' % (connection._nickname, nickname))
+            connection.send(b':server 432 %s %s :Erroneous nickname\r\n' % (connection._nickname, nickname))
             return
         
-        self._datamutex.acquire()
-        available = self.try_new_nickname(connection, nickname)
-        self._datamutex.release()
-
-        if available:
+        old_key = connection._nick_key
+        if self.try_new_nickname(connection, nickname):
             if connection._nickname == b'*':
                 connection.send(b':server 001 %s :Welcome\r\n' % nickname)
                 connection.send(b':server 422 %s :MOTD File is missing\r\n' % nickname)
             else:
-                self._datamutex.acquire()
+                for channel in connection._channels:
+                    self._channels[channel].rename(old_key, connection._nick_key)
+
                 colleagues = self.find_colleagues(connection)
-                self._datamutex.release()
-
-                messages = set()
-                for colleague in colleagues:
-                    message = asyncio.create_task(
-                        self.send_async(
-                            colleague,
-                            b':%s NICK %s\r\n' % (connection._nickname, nickname)
-                        )
-                    )
-                    messages.add(message)
-                    message.add_done_callback(messages.discard)
+                self.broadcast(colleagues, b':%s NICK %s\r\n' % (connection._nickname, nickname))
 
             connection._nickname = nickname 
         else:
             connection.send(b':server 433 %s %s :Nickname is already in use\r\n' % (connection._nickname, nickname))
 
+    def process_privmsg(self, connection, recipient, content):
+        if recipient[0:1] == b'#':
+            self.process_channel_privmsg(connection, recipient, content)
+        else:
+            self.process_personal_privmsg(connection, recipient, content)
+
     def process_personal_privmsg(self, connection, recipient, content):
-        if connection._nickname != b'*' and len(content) >= 2 and content[0:1] == b':':
-            self._datamutex.acquire()
+        if connection._nickname != b'*' and len(content) > 0:
             recipient_connection = self.search_recipient(recipient)
-            self._datamutex.release()
 
             if recipient_connection is not None:
-                recipient_connection.send(b':%s PRIVMSG %s %s\r\n' % (connection._nickname, recipient_connection._nickname, content))
+                recipient_connection.send(b':%s PRIVMSG %s :%s\r\n' % (connection._nickname, recipient_connection._nickname, content))
+                if self._over_sendq(recipient_connection):
+                    self.evict(recipient_connection, b'SendQ exceeded')
 
     def process_channel_privmsg(self, connection, channel, content):
-        if connection._nickname != b'*' and len(content) >= 2 and content[0:1] == b':':
-            self._datamutex.acquire()
-            channel_connections = self.search_channel(channel)
-            self._datamutex.release()
-
-            if channel_connections is not None:
-                messages = set()
-                for member in channel_connections:
-                    if member is not connection:
-                        message = asyncio.create_task(
-                            self.send_async(
-                                member,
-                                b':%s PRIVMSG %s %s\r\n' % (connection._nickname, channel.lower(), content)
-                            )
-                        )
-                        messages.add(message)
-                        message.add_done_callback(messages.discard)
+        if connection._nickname != b'*' and len(content) > 0:
+            channel = self.search_channel(channel)
+
+            if channel is not None:
+                self.broadcast(
+                    channel.members,
+                    b':%s PRIVMSG %s :%s\r\n' % (connection._nickname, channel.name, content),
+                    sender=connection
+                )
 
     def process_join(self, connection, channel):
+        if connection._nickname == b'*':
+            return
         if channel[0:1] == b'#' and self.validate_nickname(channel[1:]):
-            self._datamutex.acquire()
-            members = self.add_member_to_channel(connection, channel)
-            self._datamutex.release()
-            connection._channels.add(channel.lower())
-
-            messages = set()
-            for member in members:
-                if member is not connection:
-                    message = asyncio.create_task(
-                        self.send_async(
-                            member,
-                            b':%s JOIN :%s\r\n' % (connection._nickname, channel.lower())
-                        )
-                    )
-                    messages.add(message)
-                    message.add_done_callback(messages.discard)
-            connection.send(b':%s JOIN :%s\r\n' % (connection._nickname, channel.lower()))
-
-            member_names = sorted(list(map((lambda c: c._nickname.lower()), members)))
-            msg_buffer = b':server 353 %s = %s :' % (connection._nickname, channel.lower())
-            for name in member_names:
-                if len(msg_buffer + name) < 510:
-                    msg_buffer = msg_buffer + name + b' '
-                else:
-                    msg_buffer = msg_buffer[:-1] + b'\r\n'
-                    connection.send(msg_buffer)
-                    msg_buffer = b':server 353 %s = %s :%s ' % (connection._nickname, channel.lower(), name)
-            
-            msg_buffer = msg_buffer[:-1] + b'\r\n'
-            connection.send(msg_buffer)
-            connection.send(b':server 366 %s %s :End of /NAMES list.\r\n' % (connection._nickname, channel.lower()))
+            channel = self.add_member_to_channel(connection, channel)
+            connection._channels.add(channel.name)
+
+            self.broadcast(channel.members, b':%s JOIN :%s\r\n' % (connection._nickname, channel.name))
+            self.send_names(connection, channel)
         else:
             connection.send(b':server 403 %s :No such channel\r\n' % channel)
 
+    def send_names(self, connection, channel):
+        """
+        Send the NAMES list of channel, split in as many lines as needed.
+        """
+        header = b':server 353 %s = %s :' % (connection._nickname, channel.name)
+        line = bytearray(header)
+        for name in channel.names:
+            if len(line) > len(header):
+                if len(line) + 1 + len(name) + 2 > MAX_LINE_LENGTH:
+                    line += b'\r\n'
+                    connection.send(bytes(line))
+                    del line[len(header):]
+                else:
+                    line += b' '
+            line += name
+
+        line += b'\r\n'
+        connection.send(bytes(line))
+        connection.send(b':server 366 %s %s :End of /NAMES list.\r\n' % (connection._nickname, channel.name))
+
     def process_part(self, connection, channel):
         channel = channel.lower()
         if channel in connection._channels:
-            self._datamutex.acquire()
             members = self.remove_channel_member(connection, channel)
-            self._datamutex.release()
             connection._channels.remove(channel)
 
-            messages = set()
-            for member in members:
-                message = asyncio.create_task(
-                    self.send_async(
-                        member,
-                        b':%s PART %s\r\n' % (connection._nickname, channel.lower())
-                    )
-                )
-                messages.add(message)
-                message.add_done_callback(messages.discard)
-
-            connection.send(b':%s PART %s\r\n' % (connection._nickname, channel.lower()))
+            message = b':%s PART %s\r\n' % (connection._nickname, channel)
+            self.broadcast(members, message)
+            connection.send(message)
     
-    def process_exit(self, connection):
-        self._datamutex.acquire()
+    def process_exit(self, connection, reason=b'Connection closed'):
         colleagues = self.remove_from_every_channel(connection)
-        self._datamutex.release()
-
-        messages = set()
-        for colleague in colleagues:
-            message = asyncio.create_task(
-                self.send_async(
-                    colleague,
-                    b':%s QUIT :Connection closed\r\n' % connection._nickname
-                )
-            )
-            messages.add(message)
-            message.add_done_callback(messages.discard)
 
-    async def send_async(self, connection, data):
-        return connection.send(data)
+        self.broadcast(colleagues, b':%s QUIT :%s\r\n' % (connection._nickname, reason))
+
+    @boundary('irc')
+    def broadcast(self, members, message, sender=None):
+        """
+        Send an already formatted message to every member but sender and
+        those already disconnected. Members whose output backs up too much
+        are disconnected afterwards.
+        """
+        slow_members = None
+        sent = 0
+        for member in members:
+            if member is not sender and not member._gone:
+                member.send(message)
+                sent += 1
+                if self._over_sendq(member):
+                    if slow_members is None:
+                        slow_members = []
+                    slow_members.append(member)
+
+        messages_sent.inc(sent)
+        if slow_members is not None:
+            for member in slow_members:
+                self.evict(member, b'SendQ exceeded')
     
     def try_new_nickname(self, connection, nickname):
-        current_nickname = connection._nickname
-        if nickname.lower() in self._connections.keys():
+        nick_key = nickname.lower()
+        if nick_key in self._connections:
             return False
         
-        if current_nickname != b'*':
-            self._connections.pop(current_nickname.lower())
+        if connection._nick_key is not None:
+            self._connections.pop(connection._nick_key)
 
-        self._connections[nickname.lower()] = connection
+        self._connections[nick_key] = connection
+        connection._nick_key = nick_key
         return True
     
     def search_recipient(self, recipient):
@@ -232,28 +353,26 @@ class IRCServer:
     def add_member_to_channel(self, connection, channel):
         channel = channel.lower()
 
-        if channel not in self._channels.keys():
-            self._channels[channel] = set()
+        if channel not in self._channels:
+            self._channels[channel] = Channel(channel)
 
         self._channels[channel].add(connection)
         return self._channels[channel]
     
     def remove_channel_member(self, connection, channel):
-        channel = channel.lower()
-        self._channels[channel].remove(connection)
-        if len(self._channels[channel]) == 0:
+        members = self._channels[channel].remove(connection)
+        if len(members) == 0:
             self._channels.pop(channel)
-            return set()
         
-        return self._channels[channel]
+        return members
     
     def remove_from_every_channel(self, connection):
         colleagues = set()
         for channel in connection._channels:
             colleagues.update(self.remove_channel_member(connection, channel))
 
-        if connection._nickname != b'*':
-            self._connections.pop(connection._nickname)
+        if connection._nick_key is not None:
+            self._connections.pop(connection._nick_key)
 
         return colleagues
     
@@ -262,6 +381,31 @@ class IRCServer:
         colleagues.add(connection)
 
         for channel in connection._channels:
-            colleagues.update(self._channels[channel])
+            colleagues.update(self._channels[channel].members)
+
+        return colleagues
+
 
-        return colleagues
\ No newline at end of file
+class Channel:
+    def __init__(self, name):
+        """
+        Members of a channel, along with their lowercased nicknames kept in
+        sorted order for NAMES replies. The name is lowercased too.
+        """
+        self.name = name
+        self.members = set()
+        self.names = []
+
+    def add(self, connection):
+        if connection not in self.members:
+            self.members.add(connection)
+            insort(self.names, connection._nick_key)
+
+    def remove(self, connection):
+        self.members.remove(connection)
+        del self.names[bisect_left(self.names, connection._nick_key)]
+        return self.members
+
+    def rename(self, old_key, new_key):
+        del self.names[bisect_left(self.names, old_key)]
+        insort(self.names, new_key)
@@ -0,0 +1,403 @@
+import os
+import errno
+import pickle
+import socket
+import struct
+import asyncio
+import logging
+import multiprocessing
+from itertools import count
+
+from application_layer.irc import IRCServer, SENDQ_BYTES, SENDQ_LINES
+from utils.log import setup_logging
+
+# Sharded deployment of the IRC server.
+#
+# The process running the physical, link, network and transport layers
+# (the front) hands every accepted connection to one of several worker
+# processes (the shards), each running an IRCServer. Shards talk to the
+# front only, over Unix socket pairs:
+#
+#   front -> shard: ('accept', uid, connection_id, owner_shard)
+#                   ('data', uid, data)
+#                   ('event', event)
+#                   ('evict', uid, reason)
+#                   ('lost', uid, reason)
+#   shard -> front: ('send', uid, data)
+#                   ('multicast', uids, data)
+#                   ('close', uid)
+#                   ('abort', uid, last_words)
+#                   ('publish', event)
+#
+# Every shard keeps a replica of the whole server state: all clients, their
+# nicknames and channels. Commands changing it (NICK, JOIN, PART and QUIT)
+# are not applied where they are received, but published as events. The
+# front relays events to every shard in a single order, so all replicas go
+# through the same states. The shard owning the client applies the command
+# with its replies and notifications, the other ones apply it silently.
+# Input of a client is paused while one of its events is on its way.
+#
+# Output is always written by the front, which holds the TCP connections,
+# whatever the shard that produced it.
+#
+# Sharding only spreads the IRC server itself, a small part of the work:
+# the front still runs every layer below it, and a message to a channel
+# still costs it one TCP send per recipient. The front's CPU time per
+# message delivered is about the same as that of a single process server
+# (see irc_bench --workers), which bounds what more cores can bring.
+#
+# When a shard dies, the front aborts the connections of its clients and
+# tells the remaining shards they are lost, so that they forget them and
+# send the QUIT to their own clients. New clients go to the remaining
+# shards only.
+
+logger = logging.getLogger(__name__)
+
+class MessagePipe:
+    def __init__(self, sock, callback, closed_callback=None):
+        """
+        Exchange pickled messages over a stream socket, from within the
+        event loop. Messages sent during one loop iteration are written
+        together. closed_callback is called when the other end goes away.
+        """
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.callback = callback
+        self.closed_callback = closed_callback
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.flush_scheduled = False
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(self.sock, self.__readable)
+
+    def send(self, message):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.outbuf += struct.pack('!I', len(data))
+        self.outbuf += data
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.__flush)
+
+    def __flush(self):
+        self.flush_scheduled = False
+        try:
+            sent = self.sock.send(self.outbuf)
+        except BlockingIOError:
+            sent = 0
+        except (BrokenPipeError, ConnectionResetError):
+            # Other end is gone, nobody will read it
+            sent = len(self.outbuf)
+        del self.outbuf[:sent]
+        if len(self.outbuf) > 0:
+            self.loop.add_writer(self.sock, self.__writable)
+
+    def __writable(self):
+        self.loop.remove_writer(self.sock)
+        self.__flush()
+
+    def __readable(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno != errno.ECONNRESET:
+                raise e
+            data = b''
+        if data == b'':
+            # Other end is gone
+            self.loop.remove_reader(self.sock)
+            if self.closed_callback:
+                self.closed_callback()
+            return
+
+        self.inbuf += data
+        start = 0
+        while len(self.inbuf) - start >= 4:
+            size, = struct.unpack_from('!I', self.inbuf, start)
+            if len(self.inbuf) - start - 4 < size:
+                break
+            message = pickle.loads(self.inbuf[start + 4:start + 4 + size])
+            start += 4 + size
+            self.callback(message)
+        del self.inbuf[:start]
+
+
+class ShardedIRCServer:
+    def __init__(self, tcp_server, workers=None, sendq_bytes=SENDQ_BYTES,
+                 sendq_lines=SENDQ_LINES, **irc_options):
+        """
+        Serve IRC from workers processes (one per CPU by default), each one
+        running an IRCServer over the connections assigned to it. Other
+        arguments are passed to every IRCServer.
+        """
+        self.sendq_bytes = sendq_bytes
+        self.sendq_lines = sendq_lines
+        self.connections = {}
+        self.owners = {}
+        self.evicting = set()
+        self.uids = count()
+        self.pipes = []
+        self.live_shards = []
+
+        context = multiprocessing.get_context('spawn')
+        # Spawned workers start with logging unconfigured
+        log_level = logging.getLogger().getEffectiveLevel()
+        for shard in range(workers or os.cpu_count()):
+            front_end, shard_end = socket.socketpair()
+            worker = context.Process(
+                target=run_shard,
+                args=(shard_end, shard, irc_options, log_level),
+                daemon=True
+            )
+            worker.start()
+            shard_end.close()
+            self.pipes.append(MessagePipe(front_end, self._shard_message,
+                                          lambda shard=shard: self._shard_lost(shard)))
+            self.live_shards.append(shard)
+
+        tcp_server.register_accepted_connections_monitor(self.accepted_connection)
+
+    def run(self):
+        asyncio.get_event_loop().run_forever()
+
+    def accepted_connection(self, connection):
+        if not self.live_shards:
+            connection.abort(b'ERROR :Closing Link: (No server available)\r\n')
+            return
+        uid = next(self.uids)
+        shard = self.live_shards[uid % len(self.live_shards)]
+        connection._uid = uid
+        self.connections[uid] = connection
+        self.owners[uid] = shard
+        connection.register_receiver(self.data_received)
+
+        for live_shard in self.live_shards:
+            self.pipes[live_shard].send(('accept', uid, connection.connection_id, shard))
+
+    def data_received(self, connection, data):
+        uid = connection._uid
+        if uid in self.owners:
+            self.pipes[self.owners[uid]].send(('data', uid, data))
+
+    def _shard_message(self, message):
+        kind = message[0]
+        if kind == 'send':
+            self._send(message[1], message[2])
+        elif kind == 'multicast':
+            _, uids, data = message
+            for uid in uids:
+                self._send(uid, data)
+        elif kind == 'publish':
+            for shard in self.live_shards:
+                self.pipes[shard].send(('event', message[1]))
+        elif kind == 'close':
+            connection = self._forget(message[1])
+            if connection is not None:
+                connection.close()
+        elif kind == 'abort':
+            connection = self._forget(message[1])
+            if connection is not None:
+                connection.abort(message[2])
+
+    def _send(self, uid, data):
+        connection = self.connections.get(uid)
+        if connection is None:
+            return
+
+        connection.send(data)
+        queued_bytes, queued_segments = connection.pending_output()
+        if (queued_bytes > self.sendq_bytes or queued_segments > self.sendq_lines) \
+           and uid not in self.evicting:
+            # Shards can't see the transport, the owner is asked to evict
+            self.evicting.add(uid)
+            self.pipes[self.owners[uid]].send(('evict', uid, b'SendQ exceeded'))
+
+    def _forget(self, uid):
+        self.owners.pop(uid, None)
+        self.evicting.discard(uid)
+        return self.connections.pop(uid, None)
+
+    def _shard_lost(self, shard):
+        logger.error('IRC worker %d exited, disconnecting its clients', shard)
+        self.live_shards.remove(shard)
+        reason = b'Server worker exited'
+        for uid in [uid for uid, owner in self.owners.items() if owner == shard]:
+            self._forget(uid).abort(b'ERROR :Closing Link: (%s)\r\n' % reason)
+            for live_shard in self.live_shards:
+                self.pipes[live_shard].send(('lost', uid, reason))
+
+
+def run_shard(sock, shard, irc_options, log_level=logging.INFO):
+    """
+    Entry point of a worker process.
+    """
+    setup_logging(log_level)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport = ShardTransport(sock, shard)
+    server = ShardIRCServer(transport, **irc_options)
+    server.run()
+
+
+class ShardTransport:
+    def __init__(self, sock, shard):
+        """
+        Stands for the transport layer inside a worker process, with one
+        ProxyConnection for every client of the server.
+        """
+        self.shard = shard
+        self.proxies = {}
+        self.muted = False
+        self.callback = None
+        self.shard_callback = None
+        # Without the front process, the worker has nothing left to do
+        self.pipe = MessagePipe(sock, self._message, asyncio.get_event_loop().stop)
+
+    def register_accepted_connections_monitor(self, callback):
+        self.callback = callback
+
+    def register_shard_monitor(self, callback):
+        """
+        Register a function to be called with the 'event' and 'evict'
+        messages of the front.
+        """
+        self.shard_callback = callback
+
+    def publish(self, event):
+        self.pipe.send(('publish', event))
+
+    def multicast(self, uids, data):
+        if not self.muted:
+            self.pipe.send(('multicast', uids, data))
+
+    def _message(self, message):
+        kind = message[0]
+        if kind == 'data':
+            proxy = self.proxies.get(message[1])
+            if proxy is not None and proxy.callback:
+                proxy.callback(proxy, message[2])
+        elif kind == 'accept':
+            _, uid, connection_id, owner = message
+            proxy = self.proxies[uid] = ProxyConnection(self, uid, connection_id, owner == self.shard)
+            if self.callback:
+                self.callback(proxy)
+        elif self.shard_callback:
+            self.shard_callback(message)
+
+
+class ProxyConnection:
+    def __init__(self, transport, uid, connection_id, local):
+        """
+        A client of the server as seen from a worker process. Output is
+        forwarded to the front process. Only local clients, owned by this
+        worker, receive data.
+        """
+        self.transport = transport
+        self.uid = uid
+        self.connection_id = connection_id
+        self.local = local
+        self.callback = None
+
+    def register_receiver(self, callback):
+        self.callback = callback
+
+    def send(self, data):
+        if not self.transport.muted:
+            self.transport.pipe.send(('send', self.uid, data))
+
+    def close(self):
+        self.transport.pipe.send(('close', self.uid))
+
+    def abort(self, last_words=b''):
+        self.transport.pipe.send(('abort', self.uid, last_words))
+
+    def pending_output(self):
+        # Output queues are checked by the front process
+        return 0, 0
+
+
+class ShardIRCServer(IRCServer):
+    def __init__(self, transport, **irc_options):
+        """
+        IRCServer of a worker process, whose state changes are published
+        to every worker and applied in the order relayed by the front.
+        """
+        super().__init__(transport, **irc_options)
+        self.transport = transport
+        self._events = {
+            'nick': IRCServer.process_nick,
+            'join': IRCServer.process_join,
+            'part': IRCServer.process_part,
+            'quit': IRCServer.process_exit,
+        }
+        transport.register_shard_monitor(self.shard_message)
+
+    def accepted_connection(self, connection):
+        if connection.local:
+            super().accepted_connection(connection)
+        else:
+            self.init_connection(connection)
+
+    def _publish(self, connection, event):
+        # Input waits until the event comes back, keeping commands in order
+        connection._throttled = asyncio.get_event_loop().create_future()
+        self.transport.publish(event)
+
+    def process_nick(self, connection, nickname):
+        self._publish(connection, ('nick', connection.uid, nickname))
+
+    def process_join(self, connection, channel):
+        self._publish(connection, ('join', connection.uid, channel))
+
+    def process_part(self, connection, channel):
+        self._publish(connection, ('part', connection.uid, channel))
+
+    def process_exit(self, connection, reason=b'Connection closed'):
+        self.transport.publish(('quit', connection.uid, reason))
+
+    def broadcast(self, members, message, sender=None):
+        uids = [member.uid for member in members if member is not sender]
+        if len(uids) > 0:
+            self.transport.multicast(uids, message)
+
+    def shard_message(self, message):
+        if message[0] == 'event':
+            self.apply_event(message[1])
+        elif message[0] == 'evict':
+            connection = self.transport.proxies.get(message[1])
+            if connection is not None:
+                self.evict(connection, message[2])
+        elif message[0] == 'lost':
+            self.drop_lost_client(message[1], message[2])
+
+    def drop_lost_client(self, uid, reason):
+        """
+        Forget a client of a worker that died. Each worker sends the QUIT
+        to its own clients, the owner can't anymore.
+        """
+        connection = self.transport.proxies.pop(uid, None)
+        if connection is None:
+            return
+        colleagues = self.remove_from_every_channel(connection)
+        self.broadcast([member for member in colleagues if member.local],
+                       b':%s QUIT :%s\r\n' % (connection._nickname, reason))
+
+    def apply_event(self, event):
+        kind, uid = event[0], event[1]
+        connection = self.transport.proxies.get(uid)
+        if connection is None:
+            return
+
+        # Only the worker owning the client produces output
+        self.transport.muted = not connection.local
+        try:
+            self._events[kind](self, connection, *event[2:])
+        finally:
+            self.transport.muted = False
+
+        if kind == 'quit':
+            del self.transport.proxies[uid]
+        elif connection.local and not connection._gone:
+            connection._throttled = None
+            self.process_lines(connection)
@@ -0,0 +1,111 @@
+import argparse
+from time import perf_counter
+
+from application_layer.irc import IRCServer
+from benchmarks.irc_bench import RESULTS_FILE, report
+
+# Benchmark of the IRC server alone, without the stack below it: clients
+# are stub connections which only count what is sent to them, so the
+# cost of the channel operations themselves is measured, per channel
+# size. Run from the repository root with
+#
+#   python -m benchmarks.channel_bench --sizes 10 100 1000 --join-sizes 100 1000 5000
+#
+# Like irc_bench, every run is appended to benchmarks/results.jsonl and
+# compared with the last run with the same parameters.
+
+CHANNEL = b'#bench'
+
+class StubTransport:
+    def register_accepted_connections_monitor(self, callback):
+        pass
+
+
+class StubConnection:
+    def __init__(self, number):
+        """
+        Connection of a client, taking whatever is sent to it at once.
+        """
+        self.connection_id = ('10.0.0.1', 1024 + number, '10.0.0.2', 7000)
+        self.sent = 0
+
+    def register_receiver(self, callback):
+        pass
+
+    def send(self, data):
+        self.sent += 1
+
+    def pending_output(self):
+        return 0, 0
+
+    def close(self):
+        pass
+
+    def abort(self, last_words=b''):
+        pass
+
+
+def make_clients(server, count):
+    clients = []
+    for number in range(count):
+        client = StubConnection(number)
+        server.accepted_connection(client)
+        server.process_nick(client, b'bench%d' % number)
+        clients.append(client)
+    return clients
+
+
+def measure_broadcast(size, messages):
+    """
+    Microseconds taken by a PRIVMSG to a channel of size members.
+    """
+    server = IRCServer(StubTransport())
+    clients = make_clients(server, size)
+    for client in clients:
+        server.process_join(client, CHANNEL)
+
+    start = perf_counter()
+    for _ in range(messages):
+        server.process_channel_privmsg(clients[0], CHANNEL, b':hello world')
+    return (perf_counter() - start) / messages * 1e6
+
+
+def measure_join(size):
+    """
+    Microseconds taken by a client joining a channel of size members, with
+    the JOIN sent to all of them and the NAMES list sent back.
+    """
+    server = IRCServer(StubTransport())
+    clients = make_clients(server, size + 1)
+    for client in clients[:-1]:
+        server.process_join(client, CHANNEL)
+
+    start = perf_counter()
+    server.process_join(clients[-1], CHANNEL)
+    return (perf_counter() - start) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of IRC channel operations on stub connections')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='channel sizes')
+    parser.add_argument('--join-sizes', type=int, nargs='+', default=[100, 1000, 5000],
+                        help='sizes of the channels joined')
+    parser.add_argument('--messages', type=int, default=200, help='messages sent to each channel')
+    parser.add_argument('--results', default=RESULTS_FILE, help='file the results are appended to')
+    parser.add_argument('--label', default=None, help='free text stored with the results')
+    options = parser.parse_args()
+
+    parameters = {'benchmark': 'channel', 'sizes': options.sizes, 'join_sizes': options.join_sizes,
+                  'messages': options.messages}
+    results = {}
+    for size in options.sizes:
+        per_message = measure_broadcast(size, options.messages)
+        results[f'broadcast_{size}_us'] = per_message
+        results[f'broadcast_{size}_us_per_member'] = per_message / size
+    for size in options.join_sizes:
+        results[f'join_{size}_us'] = measure_join(size)
+    report(options.results, options.label, parameters, results)
+
+
+if __name__ == '__main__':
+    main()
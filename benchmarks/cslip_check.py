@@ -0,0 +1,115 @@
+import struct
+import random
+import argparse
+
+from link_layer.slip import VJCompression, TYPE_COMPRESSED_TCP, TYPE_UNCOMPRESSED_TCP
+from utils.ip import IPPROTO_TCP
+from utils.tcp import make_header, fix_checksum, calc_checksum, str2addr, FLAGS_ACK
+
+# Check of the TCP/IP header compression of CSLIP (RFC 1144), without the
+# rest of the stack. Run from the repository root with
+#
+#   python -m benchmarks.cslip_check --loss 0.05
+#
+# A flow of TCP segments is compressed and uncompressed again. Without
+# loss every datagram must come back unchanged. With loss, a lost frame
+# makes the headers rebuilt from the following compressed frames wrong:
+# they must fail the TCP checksum, and the retransmission of the lost
+# segment, sent uncompressed, must bring both ends back in sync. The
+# frames sent per datagram delivered show what losses cost, compared to
+# plain SLIP.
+
+SRC_ADDRESS = '10.0.0.1'
+DST_ADDRESS = '10.0.0.2'
+WINDOW = 8      # Segments sent ahead of the first one not received
+
+def make_flow(segments, payload_size):
+    """
+    Datagrams of a TCP connection sending segments of payload_size bytes.
+    """
+    datagrams = []
+    for number in range(segments):
+        payload = bytes(random.getrandbits(8) for _ in range(payload_size))
+        segment = make_header(1024, 7000, 1000 + number * payload_size, 5000, FLAGS_ACK) + payload
+        segment = fix_checksum(segment, SRC_ADDRESS, DST_ADDRESS)
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segment), number, 0, 64,
+                             IPPROTO_TCP, 0, str2addr(SRC_ADDRESS), str2addr(DST_ADDRESS))
+        header = header[:10] + struct.pack('!H', calc_checksum(header)) + header[12:]
+        datagrams.append(header + segment)
+    return datagrams
+
+
+def receive(compression, frame):
+    if frame[0] & TYPE_COMPRESSED_TCP:
+        return compression.uncompress(frame)
+    elif frame[0] & 0xf0 == TYPE_UNCOMPRESSED_TCP:
+        return compression.remember(frame)
+    return frame
+
+
+def transfer(datagrams, loss, compressed=True):
+    """
+    Send datagrams through a compressor and a decompressor (or as they
+    are if not compressed), losing frames with probability loss. The
+    receiver keeps the datagrams that arrive out of order, the sender
+    retransmits the first missing one when WINDOW datagrams are waiting.
+    Returns the frames sent, and the datagrams discarded or rebuilt wrong
+    by the decompressor. Raises AssertionError if a wrong datagram passes
+    the TCP checksum.
+    """
+    sender, receiver = VJCompression(), VJCompression()
+    known = {datagram: number for number, datagram in enumerate(datagrams)}
+    received = set()
+    frames = wrong = 0
+    delivered = next_number = 0
+    while delivered < len(datagrams):
+        if next_number < min(len(datagrams), delivered + WINDOW):
+            number = next_number
+            next_number += 1
+        else:
+            # Retransmission timeout of the first missing segment
+            number = delivered
+        frame = datagrams[number]
+        if compressed:
+            frame = sender.compress(frame)
+        frames += 1
+        if random.random() < loss:
+            continue
+
+        datagram = receive(receiver, frame) if compressed else frame
+        if datagram in known:
+            received.add(known[datagram])
+            while delivered in received:
+                delivered += 1
+        else:
+            wrong += 1
+            assert datagram is None or calc_checksum(datagram[20:], SRC_ADDRESS, DST_ADDRESS) != 0, \
+                'a wrongly rebuilt datagram passed the TCP checksum'
+    return frames, wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check CSLIP header compression, with and without loss')
+    parser.add_argument('--segments', type=int, default=2000, help='segments of the flow')
+    parser.add_argument('--payload', type=int, default=40, help='bytes of payload per segment')
+    parser.add_argument('--loss', type=float, default=0.05, help='probability of losing a frame')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the payloads and losses')
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    datagrams = make_flow(options.segments, options.payload)
+    frames, wrong = transfer(datagrams, 0)
+    if frames != len(datagrams) or wrong != 0:
+        raise SystemExit(f'round trip failed: {wrong} of {len(datagrams)} datagrams rebuilt wrong')
+    print(f'round trip: {len(datagrams)} datagrams rebuilt unchanged')
+
+    for compressed in (False, True):
+        random.seed(options.seed)
+        frames, wrong = transfer(datagrams, options.loss, compressed)
+        print(f'{"CSLIP" if compressed else "SLIP"}, {options.loss:.0%} loss: '
+              f'{frames / len(datagrams):.2f} frames per datagram, '
+              f'{wrong} datagrams discarded or failing the TCP checksum')
+
+
+if __name__ == '__main__':
+    main()
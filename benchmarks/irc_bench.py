@@ -0,0 +1,242 @@
+import sys
+import json
+import asyncio
+import argparse
+import subprocess
+import tracemalloc
+from time import process_time, time
+
+from physical_layer.virtual import VirtualWire
+from link_layer.slip import SLIP, MODE_SLIP, MODE_CSLIP, BOND_FLOW
+from network_layer.ip import IP
+from transport_layer.tcp import TCPServer
+from application_layer.irc import IRCServer
+from application_layer.irc_cluster import ShardedIRCServer
+from utils.irc import LineBuffer, parse_message
+
+# Full-stack IRC benchmark, run offline: simulated clients connect to an
+# IRCServer through a second SLIP/IP/TCP stack and a virtual serial wire,
+# join a channel and talk in it. Run from the repository root with
+#
+#   python -m benchmarks.irc_bench --clients 50 --messages 500
+#
+# Every run is appended to benchmarks/results.jsonl (ignored by git) and
+# compared with the last run with the same parameters. The clients run in
+# the same process, so the CPU time is given for the server stack alone,
+# measured from each read of the wire to the return of its processing
+# (its timers, retransmissions for instance, are left out), and for both
+# ends. With --workers, the IRC server is sharded over worker processes,
+# whose CPU time is not counted: the server CPU time is then that of the
+# front process, which runs every layer below IRC for all the workers and
+# writes their output, and bounds what more cores can bring.
+
+SERVER_ADDRESS = '10.0.0.2'
+CLIENT_ADDRESS = '10.0.0.1'
+IRC_PORT = 7000
+CHANNEL = b'#bench'
+RESULTS_FILE = 'benchmarks/results.jsonl'
+
+class BenchClient:
+    def __init__(self, tcp, number, latencies):
+        """
+        IRC client registering as bench<number> and joining CHANNEL. The
+        delivery latency of every PRIVMSG it receives is appended to
+        latencies.
+        """
+        self.nickname = b'bench%d' % number
+        self.latencies = latencies
+        self.lines = LineBuffer()
+        self.loop = asyncio.get_event_loop()
+        self.joined = self.loop.create_future()
+        self.received = 0
+        self.connection = tcp.connect(SERVER_ADDRESS, IRC_PORT)
+        self.connection.register_receiver(self.data_received)
+        self.connection.send(b'NICK %s\r\nJOIN %s\r\n' % (self.nickname, CHANNEL))
+
+    def say(self, number):
+        # The time it was sent is carried by the message itself
+        self.connection.send(b'PRIVMSG %s :%d %r\r\n' % (CHANNEL, number, self.loop.time()))
+
+    def data_received(self, connection, data):
+        self.lines.feed(data)
+        while True:
+            line = self.lines.next_line()
+            if line is None:
+                break
+            _, command, params = parse_message(line)
+            if command == b'PRIVMSG':
+                sent_at = float(params[-1].split()[-1])
+                self.latencies.append(self.loop.time() - sent_at)
+                self.received += 1
+            elif command == b'366' and not self.joined.done():
+                self.joined.set_result(None)
+
+
+def build_stack(serial_lines, address, other_end, link_mode, bonding):
+    if len(serial_lines) == 1:
+        serial_lines = serial_lines[0]
+    network = IP(SLIP({other_end: serial_lines}, link_mode, policy=bonding))
+    network.define_host_address(address)
+    network.define_routing_table([('0.0.0.0/0', other_end)])
+    return TCPServer(network)
+
+
+def metered(function, used):
+    """
+    Wrap function so that the CPU time spent in it is added to used[0].
+    """
+    def call(*args):
+        start = process_time()
+        function(*args)
+        used[0] += process_time() - start
+
+    return call
+
+
+def meter_cpu(serial_line, used):
+    """
+    Add to used[0] the CPU time spent processing what is read from
+    serial_line, whose receiver must already be registered.
+    """
+    serial_line.register_receiver(metered(serial_line.callback, used))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(options):
+    loop = asyncio.get_event_loop()
+    wires = [VirtualWire(options.bandwidth, options.latency, options.jitter,
+                         options.loss, options.reorder, seed=options.seed + i)
+             for i in range(options.lines)]
+    server_tcp = build_stack([wire.ends[0] for wire in wires], SERVER_ADDRESS, CLIENT_ADDRESS,
+                             options.link_mode, options.bonding)
+    server_tcp.listen(IRC_PORT)
+    # Clients talk as fast as they can, the server must not slow them down
+    irc_options = dict(flood_rate=1e9, flood_burst=1e9, sendq_bytes=2**31, sendq_lines=2**31)
+    if options.workers:
+        irc = ShardedIRCServer(server_tcp, workers=options.workers, **irc_options)
+    else:
+        irc = IRCServer(server_tcp, **irc_options)
+    client_tcp = build_stack([wire.ends[1] for wire in wires], CLIENT_ADDRESS, SERVER_ADDRESS,
+                             options.link_mode, options.bonding)
+    server_cpu = [0]
+    for wire in wires:
+        meter_cpu(wire.ends[0], server_cpu)
+    if options.workers:
+        # Output of the workers, written to the connections by the front
+        for pipe in irc.pipes:
+            pipe.callback = metered(pipe.callback, server_cpu)
+
+    # Memory allocated for the connections, on both ends of the wire
+    latencies = []
+    tracemalloc.start()
+    clients = [BenchClient(client_tcp, i, latencies) for i in range(options.clients)]
+    await asyncio.wait_for(asyncio.gather(*(client.joined for client in clients)), options.timeout)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    senders = clients[:options.senders]
+    expected = options.messages * (options.clients - 1)
+    cpu_start = process_time()
+    server_cpu[0] = 0
+    start = loop.time()
+    for number in range(options.messages):
+        senders[number % len(senders)].say(number)
+        if number % options.batch == options.batch - 1:
+            await asyncio.sleep(0)
+
+    deadline = start + options.timeout
+    while len(latencies) < expected and loop.time() < deadline:
+        await asyncio.sleep(0.001)
+    elapsed = loop.time() - start
+    cpu = process_time() - cpu_start
+
+    latencies.sort()
+    delivered = len(latencies)
+    return {
+        'delivered': delivered,
+        'expected': expected,
+        'messages_per_second': delivered / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000 if delivered else None,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000 if delivered else None,
+        'server_cpu_per_message_us': server_cpu[0] / delivered * 1e6 if delivered else None,
+        'both_ends_cpu_per_message_us': cpu / delivered * 1e6 if delivered else None,
+        'memory_per_connection_bytes': memory / options.clients,
+        'chunks_lost': sum(wire.chunks_lost for wire in wires),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(path, parameters):
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    runs = [run for run in runs if run['parameters'] == parameters]
+    return runs[-1] if runs else None
+
+
+def report(path, label, parameters, results):
+    """
+    Print results, with the change since the last run with the same
+    parameters, and append them to the results file at path.
+    """
+    previous = previous_result(path, parameters)
+    for name, value in results.items():
+        line = f'{name:>28}: {value:.2f}' if isinstance(value, float) else f'{name:>28}: {value}'
+        if previous is not None and isinstance(value, (int, float)) and previous['results'].get(name):
+            change = (value - previous['results'][name]) / previous['results'][name] * 100
+            line += f'  ({change:+.1f}% since {previous["commit"]})'
+        print(line)
+
+    with open(path, 'a') as f:
+        f.write(json.dumps({
+            'time': time(),
+            'commit': git_commit(),
+            'label': label,
+            'python': sys.version.split()[0],
+            'parameters': parameters,
+            'results': results,
+        }) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Full-stack IRC benchmark over a virtual serial wire')
+    parser.add_argument('--clients', type=int, default=20, help='clients in the channel')
+    parser.add_argument('--senders', type=int, default=1, help='clients sending the messages')
+    parser.add_argument('--messages', type=int, default=200, help='messages sent to the channel')
+    parser.add_argument('--batch', type=int, default=10, help='messages sent per loop iteration')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='IRC worker processes, none to run the IRC server in the process')
+    parser.add_argument('--link-mode', default=MODE_SLIP, choices=(MODE_SLIP, MODE_CSLIP),
+                        help='header compression of the link')
+    parser.add_argument('--lines', type=int, default=1, help='serial lines bonded together')
+    parser.add_argument('--bonding', default=BOND_FLOW, help='bonding policy of several lines')
+    parser.add_argument('--bandwidth', type=float, default=None, help='wire bandwidth in bit/s')
+    parser.add_argument('--latency', type=float, default=0, help='wire latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='wire jitter in seconds')
+    parser.add_argument('--loss', type=float, default=0, help='probability of losing a frame')
+    parser.add_argument('--reorder', type=float, default=0, help='probability of delaying a frame')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the wire losses and delays')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for deliveries')
+    parser.add_argument('--results', default=RESULTS_FILE, help='file the results are appended to')
+    parser.add_argument('--label', default=None, help='free text stored with the results')
+    options = parser.parse_args()
+
+    parameters = {name: value for name, value in vars(options).items()
+                  if name not in ('timeout', 'results', 'label')}
+    report(options.results, options.label, parameters, asyncio.run(run(options)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import random
+import asyncio
+import hashlib
+import argparse
+import selectors
+from time import perf_counter
+
+from physical_layer.recorder import read_recording, INBOUND, OUTBOUND
+from link_layer.slip import VJCompression, MODE_SLIP, TYPE_COMPRESSED_TCP, TYPE_UNCOMPRESSED_TCP
+from utils.ip import IPPROTO_TCP
+from run_irc import build_server
+
+# Replay of a recording made with RecordingLine (record_file in run_irc.py)
+# through the stack, on a virtual clock: the event loop never waits, it
+# jumps to the time of the next timer or recorded chunk, so a recording
+# is replayed as fast as the stack can process it. Run from the
+# repository root with
+#
+#   python -m benchmarks.replay irc.rec
+#
+# What the stack sends is checked against the recording. The interleaving
+# of different TCP connections on the line may change from run to run, so
+# the output is compared connection by connection, each one by the digest
+# of its segments. A timer of the original run firing late, after traffic
+# it would have preceded on time, makes its connection differ.
+
+SETTLE_TIME = 0     # Seconds replayed after the end of the recording
+TIME_LIMIT = 60     # Seconds a replay may take before it is given up
+STUCK_ITERATIONS = 100000   # Loop iterations at one instant before the clock is deemed stuck
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.last_time = None
+        self.iterations = 0
+
+    def select(self, timeout=None):
+        # A timer rescheduled too close to now for the clock to move fires
+        # again and again: the replay would never end
+        if self.loop.virtual_time != self.last_time:
+            self.last_time = self.loop.virtual_time
+            self.iterations = 0
+        self.iterations += 1
+        if self.iterations > STUCK_ITERATIONS:
+            raise RuntimeError(f'virtual clock stuck at {self.last_time:.6f} s')
+        if perf_counter() > self.loop.deadline:
+            raise RuntimeError(f'replay still running at {self.loop.virtual_time:.6f} s '
+                               f'of the recording after its time limit')
+
+        ready = super().select(0)
+        if not ready:
+            if timeout is None:
+                raise RuntimeError('nothing left to do, the loop would wait forever')
+            # Waiting is just moving the clock forward
+            self.loop.virtual_time += timeout
+        return ready
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self, time_limit=TIME_LIMIT):
+        """
+        Event loop whose clock only moves when it has nothing to do. Raises
+        RuntimeError if it runs for more than time_limit real seconds, or
+        if it keeps running without its clock moving.
+        """
+        self.virtual_time = 0.0
+        self.deadline = perf_counter() + time_limit
+        super().__init__(VirtualClockSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+
+class ReplayLine:
+    def __init__(self):
+        """
+        Serial line fed with recorded chunks, keeping what is sent to it.
+        """
+        self.callback = None
+        self.sent = []
+
+    def inject(self, data):
+        if self.callback:
+            self.callback(data)
+
+    def register_receiver(self, callback):
+        self.callback = callback
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+def flow_digests(chunks):
+    """
+    SHA-256 of the segments of every TCP connection, and of the payloads
+    of every other protocol, found in chunks of SLIP (or CSLIP) frames.
+    Returns {flow: (datagrams, hex digest)}.
+    """
+    compression = VJCompression()
+    digests = {}
+    counts = {}
+    for chunk in chunks:
+        for frame in chunk.split(b'\xc0'):
+            if len(frame) == 0:
+                continue
+            frame = frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+            if frame[0] & TYPE_COMPRESSED_TCP:
+                datagram = compression.uncompress(frame)
+            elif frame[0] & 0xf0 == TYPE_UNCOMPRESSED_TCP:
+                datagram = compression.remember(frame)
+            else:
+                datagram = frame
+            if datagram is None:
+                continue
+
+            header_size = 4 * (datagram[0] & 0xf)
+            protocol = datagram[9]
+            if protocol == IPPROTO_TCP:
+                flow = (bytes(datagram[16:20]), bytes(datagram[header_size:header_size + 4]))
+            else:
+                flow = (bytes(datagram[16:20]), protocol)
+            if flow not in digests:
+                digests[flow] = hashlib.sha256()
+                counts[flow] = 0
+            digests[flow].update(bytes(datagram[header_size:]))
+            counts[flow] += 1
+    return {flow: (counts[flow], digest.hexdigest()) for flow, digest in digests.items()}
+
+
+def replay(path, link_mode=MODE_SLIP, settle=SETTLE_TIME, time_limit=TIME_LIMIT):
+    """
+    Replay the recording at path through a new stack. Returns the seconds
+    covered by the recording, the seconds the replay took, the digests of
+    the recorded output and those of the replayed one. Raises RuntimeError
+    if the replay takes more than time_limit seconds or stops moving the
+    clock.
+    """
+    seed, records = read_recording(path)
+    loop = VirtualClockLoop(time_limit)
+    asyncio.set_event_loop(loop)
+    try:
+        # Seeded as the original stack was, before it was built
+        random.seed(seed)
+        line = ReplayLine()
+        build_server(line, link_mode)
+
+        for at, direction, data in records:
+            if direction == INBOUND:
+                loop.call_at(at, line.inject, data)
+        duration = records[-1][0] if records else 0
+        loop.call_at(duration + settle, loop.stop)
+
+        start = perf_counter()
+        loop.run_forever()
+        elapsed = perf_counter() - start
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    recorded = flow_digests(data for _, direction, data in records if direction == OUTBOUND)
+    return duration, elapsed, recorded, flow_digests(line.sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recording of the serial line through the stack')
+    parser.add_argument('recording', help='file written by RecordingLine')
+    parser.add_argument('--link-mode', default=MODE_SLIP, help='link_mode of the recorded server')
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME,
+                        help='seconds replayed after the end of the recording')
+    parser.add_argument('--time-limit', type=float, default=TIME_LIMIT,
+                        help='seconds the replay may take before it fails')
+    options = parser.parse_args()
+
+    duration, elapsed, recorded, replayed = replay(options.recording, options.link_mode,
+                                                   options.settle, options.time_limit)
+    print(f'replayed {duration:.1f} s of traffic in {elapsed:.3f} s')
+
+    mismatches = [flow for flow in recorded if recorded[flow] != replayed.get(flow)]
+    print(f'{len(recorded) - len(mismatches)} of {len(recorded)} flows sent the same output')
+    for flow in mismatches:
+        print(f'  {flow}: {recorded[flow][0]} datagrams recorded, '
+              f'{replayed.get(flow, (0,))[0]} replayed')
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
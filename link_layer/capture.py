@@ -0,0 +1,130 @@
+import struct
+import asyncio
+from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.ip import IPPROTO_TCP, IPPROTO_UDP
+from utils.tcp import str2addr
+from utils.metrics import REGISTRY
+
+CAPTURE_RING = 4096         # Datagrams held in memory between two flushes
+CAPTURE_INTERVAL = 1.0      # Seconds between two flushes to the file
+LINKTYPE_RAW = 101          # Packets start with the IPv4 header
+
+INBOUND = 'in'
+OUTBOUND = 'out'
+
+packets_captured = REGISTRY.counter('capture_packets_total', 'Datagrams captured')
+packets_lost = REGISTRY.counter('capture_packets_lost_total', 'Captured datagrams overwritten before being written')
+
+class CaptureFilter:
+    def __init__(self, host=None, port=None, protocol=None, flags=None, direction=None):
+        """
+        Select datagrams to capture, like a BPF filter: every given
+        condition must hold. host matches the source or destination
+        address ('x.y.z.w'), port the source or destination TCP or UDP
+        port, protocol the IP protocol number, flags any of the TCP flags
+        in the mask (FLAGS_SYN | FLAGS_RST, for instance) and direction
+        INBOUND or OUTBOUND.
+        """
+        self.host = str2addr(host) if host is not None else None
+        self.port = port
+        self.protocol = protocol
+        self.flags = flags
+        self.direction = direction
+
+    def match(self, datagram, direction):
+        if self.direction is not None and direction != self.direction:
+            return False
+        if self.host is not None and \
+           datagram[12:16] != self.host and datagram[16:20] != self.host:
+            return False
+
+        protocol = datagram[9]
+        if self.protocol is not None and protocol != self.protocol:
+            return False
+        if self.port is None and self.flags is None:
+            return True
+
+        # Ports and flags are only found in the first fragment
+        header_size = 4 * (datagram[0] & 0xf)
+        if struct.unpack('!H', datagram[6:8])[0] & 0x1fff != 0:
+            return False
+        if self.port is not None:
+            if protocol not in (IPPROTO_TCP, IPPROTO_UDP):
+                return False
+            src_port, dst_port = struct.unpack('!HH', datagram[header_size:header_size + 4])
+            if self.port != src_port and self.port != dst_port:
+                return False
+        if self.flags is not None:
+            if protocol != IPPROTO_TCP or len(datagram) < header_size + 14:
+                return False
+            if datagram[header_size + 13] & self.flags == 0:
+                return False
+        return True
+
+
+class Capture:
+    def __init__(self, path, capture_filter=None, ring_size=CAPTURE_RING,
+                 interval=CAPTURE_INTERVAL, snaplen=65535):
+        """
+        Capture datagrams to a pcap file at path (LINKTYPE_RAW). Recording
+        a datagram only appends it to an in-memory ring of ring_size
+        entries. Every interval seconds, the ring is handed over to a
+        background thread that writes it to the file. If datagrams come
+        faster than they are written, the oldest ones are lost.
+        """
+        self.filter = capture_filter
+        self.snaplen = snaplen
+        self.interval = interval
+        self.ring = deque(maxlen=ring_size)
+        self.recorded = 0
+        self.loop = asyncio.get_event_loop()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.file = open(path, 'wb')
+        self.file.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, snaplen, LINKTYPE_RAW))
+        self.timer = self.loop.call_later(interval, self._flush_timer)
+
+    def record(self, datagram, direction):
+        if self.filter is not None and not self.filter.match(datagram, direction):
+            return
+        self.ring.append((time(), datagram))
+        self.recorded += 1
+
+    def flush(self):
+        """
+        Hand the recorded datagrams to the writing thread. Returns a
+        future completed once they are written.
+        """
+        records = self.ring
+        self.ring = deque(maxlen=records.maxlen)
+        recorded, self.recorded = self.recorded, 0
+        packets_captured.inc(len(records))
+        packets_lost.inc(recorded - len(records))
+        return self.loop.run_in_executor(self.writer, self._write, records)
+
+    def close(self):
+        """
+        Stop capturing, writing what is left and closing the file from the
+        writing thread.
+        """
+        self.timer.cancel()
+        self.flush()
+        return self.loop.run_in_executor(self.writer, self.file.close)
+
+    def _flush_timer(self):
+        if len(self.ring) > 0:
+            self.flush()
+        self.timer = self.loop.call_later(self.interval, self._flush_timer)
+
+    def _write(self, records):
+        data = bytearray()
+        for timestamp, datagram in records:
+            seconds = int(timestamp)
+            captured = datagram[:self.snaplen]
+            data += struct.pack('<IIII', seconds, int((timestamp - seconds) * 1e6),
+                                len(captured), len(datagram))
+            data += captured
+        self.file.write(data)
+        self.file.flush()
@@ -1,9 +1,38 @@
-import traceback
+import zlib
+import errno
+import struct
+import asyncio
+import logging
+
+from utils.ip import IPPROTO_TCP, IPPROTO_UDP
+from utils.tcp import calc_checksum
+from utils.metrics import REGISTRY
+from utils.trace import boundary
+from link_layer.capture import Capture, INBOUND, OUTBOUND
+
+MODE_SLIP = 'slip'
+MODE_CSLIP = 'cslip'
+MODE_ADAPTIVE = 'adaptive'
+
+BOND_FLOW = 'flow'
+BOND_ROUND_ROBIN = 'round-robin'
+KEEPALIVE_INTERVAL = 1.0    # Seconds a bonded line may stay idle before an END byte is sent
+RETRY_INTERVAL = 1.0        # Seconds before a bonded line that failed is tried again
+
+logger = logging.getLogger(__name__)
+
+frames_sent = REGISTRY.counter('slip_frames_sent_total', 'Frames sent')
+frames_received = REGISTRY.counter('slip_frames_received_total', 'Frames decoded')
+frames_compressed = REGISTRY.counter('slip_frames_compressed_total', 'Frames sent with a compressed TCP/IP header')
+frames_failed = REGISTRY.counter('slip_frames_dropped_total', 'Frames dropped', reason='error')
+frames_undecodable = REGISTRY.counter('slip_frames_dropped_total', 'Frames dropped', reason='compression')
+failovers = REGISTRY.counter('slip_bonded_line_failures_total', 'Bonded lines taken out of use')
 
 class SLIP:
     ignore_checksum = False
+    mtu = 1500
 
-    def __init__(self, serial_lines):
+    def __init__(self, serial_lines, mode=MODE_SLIP, **bonding):
         """
         Instantiate a data link layer with one or more links, each connected
         to a distinct serial line. The argument serial_lines is a dictionary 
@@ -11,12 +40,21 @@ class SLIP:
         of the host or router at the link's other end, written as a string of 
         the form 'x.y.z.w'. The serial_line is an object of the PTY class or 
         another one that implements register_receiver and send. 
+        The mode (MODE_SLIP, MODE_CSLIP or MODE_ADAPTIVE) is the initial
+        header compression mode of every link, see set_mode.
+        A list of serial lines may be given instead of a single one: they
+        are then bonded into a LinkGroup, to which the bonding keyword
+        arguments are passed.
         """
         self.links = {}
         self.callback = None
+        self.capture = None
         # Constructs a Link for each serial line
         for other_end_ip, serial_line in serial_lines.items():
-            link = Link(serial_line)
+            if isinstance(serial_line, (list, tuple)):
+                link = LinkGroup(serial_line, mode, **bonding)
+            else:
+                link = Link(serial_line, mode)
             self.links[other_end_ip] = link
             link.register_receiver(self._callback)
 
@@ -32,10 +70,44 @@ class SLIP:
         a string of the form 'x.y.z.w'. The link layer will be responsible for
         fiding which link next_hop is located at.
         """
+        if self.capture is not None:
+            self.capture.record(datagram, OUTBOUND)
         # Finds the Link capable of reaching next_hop and sends data through it
         self.links[next_hop].send(datagram)
 
+    def set_mode(self, next_hop, mode):
+        """
+        Choose the header compression mode of the link to next_hop, matching
+        the slattach protocol of the other end: MODE_SLIP sends plain
+        datagrams, MODE_CSLIP compresses TCP/IP headers (RFC 1144) and
+        MODE_ADAPTIVE starts plain and compresses once the other end does.
+        Compressed headers are always understood on reception.
+        """
+        self.links[next_hop].set_mode(mode)
+
+    def start_capture(self, path, capture_filter=None, **options):
+        """
+        Capture the datagrams going through every link, as seen by the
+        network layer (headers uncompressed), to a pcap file at path. Only
+        those matching capture_filter, a CaptureFilter, are kept. Other
+        options are passed to Capture. A running capture is stopped first.
+        """
+        self.stop_capture()
+        self.capture = Capture(path, capture_filter, **options)
+
+    def stop_capture(self):
+        """
+        Stop capturing. Returns a future completed once the file is closed,
+        or None if there was no capture.
+        """
+        if self.capture is None:
+            return None
+        capture, self.capture = self.capture, None
+        return capture.close()
+
     def _callback(self, datagram):
+        if self.capture is not None:
+            self.capture.record(datagram, INBOUND)
         if self.callback:
             self.callback(datagram)
 
@@ -44,16 +116,28 @@ _STATE_READING = 1
 _STATE_ESCAPE = 2
 
 class Link:
-    def __init__(self, serial_line):
+    def __init__(self, serial_line, mode=MODE_SLIP):
         self.serial_line = serial_line
         self.serial_line.register_receiver(self.__raw_recv)
         self.buffer = b''
         self.state = _STATE_IDLE
+        self.compression = VJCompression()
+        self.set_mode(mode)
 
     def register_receiver(self, callback):
         self.callback = callback
 
+    def set_mode(self, mode):
+        assert mode in (MODE_SLIP, MODE_CSLIP, MODE_ADAPTIVE)
+        self.mode = mode
+
+    @boundary('link')
     def send(self, datagram):
+        if self.mode == MODE_CSLIP:
+            datagram = self.compression.compress(datagram)
+            if datagram[0] & TYPE_COMPRESSED_TCP:
+                frames_compressed.inc()
+
         frame = b''
         for byte in bytearray(datagram):
             byte = byte.to_bytes(1, 'big', signed=False)
@@ -66,8 +150,10 @@ class Link:
                 frame = frame + byte
 
         frame = b'\xC0' + frame + b'\xC0'
+        frames_sent.inc()
         self.serial_line.send(frame)
 
+    @boundary('link')
     def __raw_recv(self, data):
         for byte in data:
             byte = byte.to_bytes(1, 'big', signed=False)
@@ -82,11 +168,13 @@ class Link:
             elif self.state == _STATE_READING:
                 if byte == b'\xC0':
                     if len(self.buffer) > 0: # Ignoring empty frames
+                        frames_received.inc()
                         try:
-                            self.callback(self.buffer)
-                        except:
-                            # ignores exception, but prints it
-                            traceback.print_exc()
+                            self._deliver(self.buffer)
+                        except Exception:
+                            frames_failed.inc()
+                            # ignores exception, but logs it
+                            logger.exception('Error while delivering a frame')
 
                     self.buffer = b''
                     self.state = _STATE_IDLE
@@ -101,3 +189,477 @@ class Link:
                     self.buffer = self.buffer + b'\xDB'
 
                 self.state = _STATE_READING
+
+    @boundary('link')
+    def _deliver(self, frame):
+        packet_type = frame[0] & 0xf0
+        if packet_type & TYPE_COMPRESSED_TCP:
+            datagram = self.compression.uncompress(frame)
+        elif packet_type == TYPE_UNCOMPRESSED_TCP:
+            datagram = self.compression.remember(frame)
+        else:
+            datagram = frame
+
+        if packet_type != TYPE_IP and self.mode == MODE_ADAPTIVE:
+            # The other end compresses, so it will understand us doing it too
+            self.mode = MODE_CSLIP
+        if datagram is not None:
+            self.callback(datagram)
+        else:
+            frames_undecodable.inc()
+
+
+class LinkGroup:
+    def __init__(self, serial_lines, mode=MODE_SLIP, policy=BOND_FLOW, weights=None,
+                 keepalive=KEEPALIVE_INTERVAL, dead_after=None):
+        """
+        Several serial lines to the same next hop, used as a single link.
+        With policy BOND_FLOW, datagrams are spread by a hash of their flow
+        (addresses, protocol and ports), so each TCP connection stays on
+        one line and is never reordered. With BOND_ROUND_ROBIN, they are
+        spread by weighted round-robin (weights default to 1 per line),
+        which lets a single connection use every line, at the cost of
+        some reordering.
+        A line is taken out of use when writing to it fails (EIO when the
+        other end is closed) and tried again after RETRY_INTERVAL. Lines
+        idle for keepalive seconds get an END byte, which every SLIP
+        implementation ignores. If dead_after is given, a line nothing
+        was received from for that many seconds is also taken out of use
+        until it is heard from again; the other end must then keep every
+        line busy too (outfill in Linux's slattach).
+        """
+        self.loop = asyncio.get_event_loop()
+        self.lines = [_BondedLine(self, serial_line) for serial_line in serial_lines]
+        self.links = [Link(line, mode) for line in self.lines]
+        self.policy = policy
+        self.weights = weights or [1] * len(self.lines)
+        self.credits = [0] * len(self.lines)
+        self.keepalive = keepalive
+        self.dead_after = dead_after
+        self.live = list(range(len(self.lines)))
+        if keepalive is not None or dead_after is not None:
+            self.loop.call_later(self._check_interval(), self._check_lines)
+
+    def register_receiver(self, callback):
+        for link in self.links:
+            link.register_receiver(callback)
+
+    def set_mode(self, mode):
+        for link in self.links:
+            link.set_mode(mode)
+
+    def send(self, datagram):
+        while True:
+            live = self.live or range(len(self.lines))
+            if self.policy == BOND_FLOW:
+                index = live[_flow_hash(datagram) % len(live)]
+            else:
+                index = self._next_round_robin(live)
+            try:
+                self.links[index].send(datagram)
+                return
+            except OSError as e:
+                if e.errno != errno.EIO or not self.live:
+                    raise e
+                self._fail(index)
+
+    def _next_round_robin(self, live):
+        # Smooth weighted round-robin, as nginx does
+        total = 0
+        best = None
+        for index in live:
+            self.credits[index] += self.weights[index]
+            total += self.weights[index]
+            if best is None or self.credits[index] > self.credits[best]:
+                best = index
+        self.credits[best] -= total
+        return best
+
+    def _fail(self, index):
+        line = self.lines[index]
+        line.retry_at = self.loop.time() + RETRY_INTERVAL
+        if index in self.live:
+            self.live.remove(index)
+            failovers.inc()
+            logger.warning('Bonded line %d is out of use', index)
+
+    def _revive(self, index):
+        if index not in self.live:
+            self.live.append(index)
+            self.live.sort()
+            logger.warning('Bonded line %d is back in use', index)
+
+    def _check_interval(self):
+        return min(interval for interval in (self.keepalive, self.dead_after, RETRY_INTERVAL)
+                   if interval is not None)
+
+    def _check_lines(self):
+        now = self.loop.time()
+        for index, line in enumerate(self.lines):
+            heard = self.dead_after is None or now - line.last_heard < self.dead_after
+            if index not in self.live:
+                if heard and line.retry_at <= now:
+                    self._revive(index)
+            elif not heard:
+                self._fail(index)
+            elif self.keepalive is not None and now - line.last_sent >= self.keepalive:
+                try:
+                    line.send(b'\xC0')
+                except OSError as e:
+                    if e.errno != errno.EIO:
+                        raise e
+                    self._fail(index)
+        self.loop.call_later(self._check_interval(), self._check_lines)
+
+
+class _BondedLine:
+    def __init__(self, group, serial_line):
+        """
+        Serial line of a LinkGroup, keeping track of its activity.
+        """
+        self.group = group
+        self.serial_line = serial_line
+        self.callback = None
+        self.last_heard = self.last_sent = group.loop.time()
+        self.retry_at = 0
+        serial_line.register_receiver(self._receive)
+
+    def _receive(self, data):
+        self.last_heard = self.group.loop.time()
+        if self.callback:
+            self.callback(data)
+
+    def register_receiver(self, callback):
+        self.callback = callback
+
+    def send(self, data):
+        self.last_sent = self.group.loop.time()
+        self.serial_line.send(data)
+
+
+def _flow_hash(datagram):
+    """
+    Hash of the flow of a datagram: addresses and protocol, with the
+    ports of TCP and UDP. Every fragment of a datagram hashes alike.
+    """
+    protocol = datagram[9]
+    addresses = zlib.crc32(datagram[12:20], protocol)
+    # MF flag or fragment offset
+    if protocol in (IPPROTO_TCP, IPPROTO_UDP) and not (datagram[6] & 0x3f or datagram[7]):
+        header_size = 4 * (datagram[0] & 0xf)
+        return zlib.crc32(datagram[header_size:header_size + 4], addresses)
+    return addresses
+
+
+# Van Jacobson TCP/IP header compression (RFC 1144), as done by Linux's cslip.
+# The packet type is carried in the first byte of the frame.
+TYPE_IP = 0x40
+TYPE_UNCOMPRESSED_TCP = 0x70
+TYPE_COMPRESSED_TCP = 0x80
+
+MAX_STATES = 16
+# TCP packets sent on a link since a slot was last used before another
+# connection may take it over. With more active connections than slots,
+# taking over the least recently used one on every miss would leave none
+# compressed; the connections without a slot are sent as plain IP instead.
+SLOT_IDLE_PACKETS = 4 * MAX_STATES
+
+# Bits of the change mask of a compressed packet
+NEW_C = 0x40
+NEW_I = 0x20
+TCP_PUSH_BIT = 0x10
+NEW_S = 0x08
+NEW_A = 0x04
+NEW_W = 0x02
+NEW_U = 0x01
+
+# Reserved masks for the two common cases of unidirectional and echoed data
+SPECIAL_I = NEW_S | NEW_W | NEW_U
+SPECIAL_D = NEW_S | NEW_A | NEW_W | NEW_U
+SPECIALS_MASK = NEW_S | NEW_A | NEW_W | NEW_U
+
+_TH_FIN = 0x01
+_TH_SYN = 0x02
+_TH_RST = 0x04
+_TH_PUSH = 0x08
+_TH_ACK = 0x10
+_TH_URG = 0x20
+
+def _encode(n):
+    # Deltas that are never 0 take a single byte when smaller than 256
+    if n >= 256:
+        return struct.pack('!BH', 0, n)
+    return bytes((n,))
+
+
+def _encodez(n):
+    # Same as _encode, but 0 must be encoded in three bytes
+    if n >= 256 or n == 0:
+        return struct.pack('!BH', 0, n)
+    return bytes((n,))
+
+
+def _decode(packet, pos):
+    if packet[pos] == 0:
+        return (packet[pos + 1] << 8) | packet[pos + 2], pos + 3
+    return packet[pos], pos + 1
+
+
+class VJCompression:
+    def __init__(self):
+        """
+        Compression state of one serial link: MAX_STATES connection slots
+        in each direction, holding the last header sent or received for a
+        TCP connection.
+        """
+        self.xmit_headers = [None] * MAX_STATES
+        self.xmit_order = list(range(MAX_STATES))   # most recently used first
+        self.xmit_used = [0] * MAX_STATES           # packet count at the last use
+        self.xmit_packets = 0
+        self.last_xmit = None
+        self.recv_headers = [None] * MAX_STATES
+        self.last_recv = None
+        self.toss = True
+
+    def compress(self, datagram):
+        """
+        Compress the header of datagram against the previous one of its
+        connection. The returned frame carries its packet type in the
+        first byte; datagrams that can't be compressed are returned as is.
+        """
+        if len(datagram) < 40 or datagram[9] != 6:
+            return datagram
+        ip_len = (datagram[0] & 0xf) * 4
+        tcp_len = (datagram[ip_len + 12] >> 4) * 4
+        header_len = ip_len + tcp_len
+        if datagram[6] & 0x3f or datagram[7] or len(datagram) < header_len:
+            # Fragments can't be compressed
+            return datagram
+        flags = datagram[ip_len + 13]
+        if flags & (_TH_SYN | _TH_FIN | _TH_RST | _TH_ACK) != _TH_ACK:
+            return datagram
+
+        # Finds the slot of this connection, by addresses and ports
+        self.xmit_packets += 1
+        for position, slot in enumerate(self.xmit_order):
+            old = self.xmit_headers[slot]
+            if old is not None and old[12:20] == datagram[12:20] and \
+               old[ip_len:ip_len + 4] == datagram[ip_len:ip_len + 4]:
+                break
+        else:
+            # Reuses the least recently used slot, unless its connection is
+            # still active
+            position = MAX_STATES - 1
+            slot = self.xmit_order[position]
+            if self.xmit_headers[slot] is not None and \
+               self.xmit_packets - self.xmit_used[slot] <= SLOT_IDLE_PACKETS:
+                return datagram
+            old = None
+        self.xmit_used[slot] = self.xmit_packets
+        if position > 0:
+            del self.xmit_order[position]
+            self.xmit_order.insert(0, slot)
+
+        header = datagram[:header_len]
+        self.xmit_headers[slot] = header
+        packet = None
+        if old is not None:
+            packet = self._compress_against(old, datagram, ip_len, header_len, flags)
+
+        if packet is None:
+            # Sends it uncompressed, so both ends agree on the slot contents
+            self.last_xmit = slot
+            frame = bytearray(datagram)
+            frame[0] |= TYPE_UNCOMPRESSED_TCP
+            frame[9] = slot
+            return bytes(frame)
+
+        changes, deltas = packet
+        if self.last_xmit != slot:
+            self.last_xmit = slot
+            start = bytes((TYPE_COMPRESSED_TCP | NEW_C | changes, slot))
+        else:
+            start = bytes((TYPE_COMPRESSED_TCP | changes,))
+        checksum = datagram[ip_len + 16:ip_len + 18]
+        return start + checksum + deltas + datagram[header_len:]
+
+    def _compress_against(self, old, new, ip_len, header_len, flags):
+        """
+        Returns the change mask and encoded deltas of new relative to old,
+        or None if new has to be sent uncompressed.
+        """
+        th = ip_len
+        if old[0:2] != new[0:2] or old[6:10] != new[6:10] or \
+           old[th + 12] != new[th + 12] or len(old) != header_len or \
+           old[20:ip_len] != new[20:ip_len] or \
+           old[th + 20:header_len] != new[th + 20:header_len]:
+            # IP header, IP options, TCP header size or TCP options changed
+            return None
+
+        old_len, old_id = struct.unpack('!HH', old[2:6])
+        new_len, new_id = struct.unpack('!HH', new[2:6])
+        old_seq, old_ack = struct.unpack('!II', old[th + 4:th + 12])
+        new_seq, new_ack = struct.unpack('!II', new[th + 4:th + 12])
+        old_win, old_urp = struct.unpack('!H2xH', old[th + 14:th + 20])
+        new_win, new_urp = struct.unpack('!H2xH', new[th + 14:th + 20])
+
+        changes = 0
+        deltas = b''
+        if flags & _TH_URG:
+            deltas += _encodez(new_urp)
+            changes |= NEW_U
+        elif new_urp != old_urp:
+            return None
+
+        delta_w = (new_win - old_win) & 0xffff
+        if delta_w:
+            deltas += _encode(delta_w)
+            changes |= NEW_W
+
+        delta_a = (new_ack - old_ack) & 0xffffffff
+        if delta_a:
+            if delta_a > 0xffff:
+                return None
+            deltas += _encode(delta_a)
+            changes |= NEW_A
+
+        delta_s = (new_seq - old_seq) & 0xffffffff
+        if delta_s:
+            if delta_s > 0xffff:
+                return None
+            deltas += _encode(delta_s)
+            changes |= NEW_S
+
+        if changes == 0:
+            # Data following an ACK-only packet is fine; anything else is
+            # probably a retransmission, sent uncompressed in case the
+            # other end missed the previous compressed packet
+            if new_len == old_len or old_len != header_len:
+                return None
+        elif changes == SPECIAL_I or changes == SPECIAL_D:
+            return None
+        elif changes == NEW_S | NEW_A:
+            if delta_s == delta_a and delta_s == old_len - header_len:
+                changes = SPECIAL_I
+                deltas = b''
+        elif changes == NEW_S:
+            if delta_s == old_len - header_len:
+                changes = SPECIAL_D
+                deltas = b''
+
+        delta_i = (new_id - old_id) & 0xffff
+        if delta_i != 1:
+            deltas += _encodez(delta_i)
+            changes |= NEW_I
+        if flags & _TH_PUSH:
+            changes |= TCP_PUSH_BIT
+
+        return changes, deltas
+
+    def remember(self, frame):
+        """
+        Receive an uncompressed TCP packet, whose protocol field holds the
+        slot number, storing its header in that slot.
+        """
+        if len(frame) < 40 or frame[9] >= MAX_STATES:
+            self.toss = True
+            return None
+
+        datagram = bytearray(frame)
+        datagram[0] &= 0x4f
+        slot = datagram[9]
+        datagram[9] = 6
+        ip_len = (datagram[0] & 0xf) * 4
+        header_len = ip_len + (datagram[ip_len + 12] >> 4) * 4
+        if len(datagram) < header_len:
+            self.toss = True
+            return None
+
+        self.recv_headers[slot] = bytes(datagram[:header_len])
+        self.last_recv = slot
+        self.toss = False
+        return bytes(datagram)
+
+    def uncompress(self, frame):
+        """
+        Rebuild the datagram of a compressed TCP packet from the header
+        stored in its slot. Returns None and discards compressed packets
+        until the next explicit slot number if anything looks wrong.
+        """
+        try:
+            return self._uncompress(frame)
+        except (IndexError, struct.error):
+            self.toss = True
+            return None
+
+    def _uncompress(self, frame):
+        changes = frame[0]
+        pos = 1
+        if changes & NEW_C:
+            slot = frame[1]
+            pos = 2
+            if slot >= MAX_STATES or self.recv_headers[slot] is None:
+                self.toss = True
+                return None
+            self.toss = False
+            self.last_recv = slot
+        elif self.toss:
+            return None
+
+        header = bytearray(self.recv_headers[self.last_recv])
+        th = (header[0] & 0xf) * 4
+        header_len = len(header)
+        header[th + 16:th + 18] = frame[pos:pos + 2]
+        pos += 2
+
+        flags = header[th + 13]
+        if changes & TCP_PUSH_BIT:
+            flags |= _TH_PUSH
+        else:
+            flags &= ~_TH_PUSH
+
+        old_len, ip_id = struct.unpack('!HH', header[2:6])
+        seq, ack = struct.unpack('!II', header[th + 4:th + 12])
+        win, urp = struct.unpack('!H2xH', header[th + 14:th + 20])
+
+        special = changes & SPECIALS_MASK
+        if special == SPECIAL_I:
+            delta = old_len - header_len
+            ack += delta
+            seq += delta
+        elif special == SPECIAL_D:
+            seq += old_len - header_len
+        else:
+            if changes & NEW_U:
+                flags |= _TH_URG
+                urp, pos = _decode(frame, pos)
+            else:
+                flags &= ~_TH_URG
+            if changes & NEW_W:
+                delta, pos = _decode(frame, pos)
+                win += delta
+            if changes & NEW_A:
+                delta, pos = _decode(frame, pos)
+                ack += delta
+            if changes & NEW_S:
+                delta, pos = _decode(frame, pos)
+                seq += delta
+
+        if changes & NEW_I:
+            delta, pos = _decode(frame, pos)
+            ip_id += delta
+        else:
+            ip_id += 1
+
+        if pos > len(frame):
+            raise IndexError('truncated compressed header')
+        header[th + 13] = flags
+        header[th + 4:th + 12] = struct.pack('!II', seq & 0xffffffff, ack & 0xffffffff)
+        header[th + 14:th + 16] = struct.pack('!H', win & 0xffff)
+        header[th + 18:th + 20] = struct.pack('!H', urp)
+        header[2:6] = struct.pack('!HH', header_len + len(frame) - pos, ip_id & 0xffff)
+        header[10:12] = b'\x00\x00'
+        header[10:12] = struct.pack('!H', calc_checksum(header[:th]))
+
+        self.recv_headers[self.last_recv] = bytes(header)
+        return bytes(header) + frame[pos:]
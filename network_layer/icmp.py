@@ -0,0 +1,157 @@
+import asyncio
+from random import randint
+
+from utils.ip import *
+from utils.icmp import *
+from utils.ratelimit import TokenBucket
+from utils.metrics import REGISTRY
+
+ERROR_RATE = 10     # ICMP errors generated per second, on average
+ERROR_BURST = 20    # ICMP errors that may be generated back to back
+PMTU_TIMEOUT = 600  # Seconds before a learned path MTU is forgotten (RFC 1191)
+MIN_MTU = 68        # Smallest MTU every IPv4 link must support (RFC 791)
+ECHO_TIMEOUT = 10   # Seconds an echo request waits for its reply
+
+echoes_answered = REGISTRY.counter('icmp_echo_requests_answered_total', 'Echo requests answered')
+errors_sent = REGISTRY.counter('icmp_errors_sent_total', 'Error messages sent')
+errors_suppressed = REGISTRY.counter('icmp_errors_suppressed_total', 'Error messages dropped by the rate limit')
+path_mtus_learned = REGISTRY.counter('icmp_path_mtus_learned_total', 'Path MTUs lowered by Fragmentation Needed messages')
+path_mtus_rejected = REGISTRY.counter('icmp_path_mtus_rejected_total',
+                                      'Fragmentation Needed messages not quoting a datagram in flight')
+
+class ICMP:
+    def __init__(self, network):
+        """
+        Instantiate the ICMP responder of a network layer. It answers echo
+        requests addressed to this host, generates rate-limited error
+        messages on behalf of the network layer and keeps the path MTUs
+        learned from Fragmentation Needed messages.
+        """
+        self.network = network
+        self.error_bucket = TokenBucket(ERROR_RATE, ERROR_BURST)
+        self.errors_suppressed = 0
+        self.path_mtus = {}
+        self.pending_echoes = {}
+        self.quote_checks = {}
+        self.echo_identifier = randint(0, 2**16 - 1)
+        self.echo_sequence = 0
+        self.network.register_protocol_handler(IPPROTO_ICMP, self._rcv)
+
+    def _rcv(self, src_addr, dst_addr, message):
+        if len(message) < 8:
+            return
+        if not self.network.ignore_checksum and calc_checksum(message) != 0:
+            return
+
+        type, code, _, rest, payload = read_icmp_header(message)
+        if type == ICMP_ECHO_REQUEST:
+            echoes_answered.inc()
+            self.network.send(make_icmp(ICMP_ECHO_REPLY, 0, rest, payload),
+                              src_addr, IPPROTO_ICMP)
+        elif type == ICMP_ECHO_REPLY:
+            pending = self.pending_echoes.pop(rest, None)
+            if pending is not None:
+                sent_at, callback, timer = pending
+                timer.cancel()
+                callback(src_addr, asyncio.get_event_loop().time() - sent_at)
+        elif type == ICMP_DEST_UNREACH and code == ICMP_FRAG_NEEDED:
+            self._learn_path_mtu(rest & 0xffff, payload)
+
+    def register_quote_check(self, protocol, check):
+        """
+        Register a function telling whether a datagram of the given
+        protocol, quoted by an ICMP error, is in flight. It is called with
+        the destination address of the datagram and the first 8 bytes of
+        its payload. Path MTUs are only learned from errors quoting such
+        datagrams (RFC 5927), so that anyone able to send ICMP to this
+        host can't lower them at will.
+        """
+        self.quote_checks[protocol] = check
+
+    def _learn_path_mtu(self, next_hop_mtu, original):
+        # The payload holds the header of the datagram that was too big,
+        # followed by the first 8 bytes of its payload
+        if len(original) < 20 or len(original) < 4 * (original[0] & 0xf) + 8:
+            path_mtus_rejected.inc()
+            return
+        header_size = 4 * (original[0] & 0xf)
+        original_dst = addr2str(original[16:20])
+        check = self.quote_checks.get(original[9])
+        if addr2str(original[12:16]) != self.network.my_address or check is None or \
+           not check(original_dst, original[header_size:header_size + 8]):
+            path_mtus_rejected.inc()
+            return
+
+        if next_hop_mtu < MIN_MTU:
+            # Router predating RFC 1191, which doesn't report the MTU
+            next_hop_mtu = MIN_MTU
+
+        if next_hop_mtu < self.path_mtu(original_dst):
+            expires = asyncio.get_event_loop().time() + PMTU_TIMEOUT
+            self.path_mtus[original_dst] = (next_hop_mtu, expires)
+            path_mtus_learned.inc()
+
+    def path_mtu(self, dest_addr):
+        """
+        Largest datagram believed to reach dest_addr without fragmentation.
+        Falls back to the MTU of the link when nothing was learned.
+        """
+        learned = self.path_mtus.get(dest_addr)
+        if learned is None:
+            return self.network.mtu
+
+        mtu, expires = learned
+        if expires <= asyncio.get_event_loop().time():
+            del self.path_mtus[dest_addr]
+            return self.network.mtu
+        return mtu
+
+    def ping(self, dest_addr, callback, payload=b'', timeout=ECHO_TIMEOUT):
+        """
+        Send an echo request to dest_addr. When the reply arrives,
+        callback is called with (src_addr, rtt), rtt given in seconds.
+        If none arrives within timeout seconds, it is called with
+        (dest_addr, None) and a late reply is ignored.
+        """
+        self.echo_sequence = (self.echo_sequence + 1) % (2**16)
+        rest = (self.echo_identifier << 16) | self.echo_sequence
+        loop = asyncio.get_event_loop()
+        timer = loop.call_later(timeout, self._echo_timeout, rest, dest_addr)
+        self.pending_echoes[rest] = (loop.time(), callback, timer)
+        self.network.send(make_icmp(ICMP_ECHO_REQUEST, 0, rest, payload),
+                          dest_addr, IPPROTO_ICMP)
+
+    def _echo_timeout(self, rest, dest_addr):
+        _, callback, _ = self.pending_echoes.pop(rest)
+        callback(dest_addr, None)
+
+    def send_error(self, type, code, datagram, rest=0):
+        """
+        Report an error about datagram back to its source. Errors are never
+        sent about ICMP errors, non-initial fragments or multicast
+        datagrams, and are dropped when the rate limit is exceeded.
+        """
+        _, _, _, _, frag_offset, _, proto, \
+            src_addr, dst_addr, payload = read_ipv4_header(datagram)
+        if frag_offset != 0 or int(dst_addr.split('.')[0]) >= 224:
+            return
+        if proto == IPPROTO_ICMP and (len(payload) == 0 or payload[0] in ICMP_ERROR_TYPES):
+            return
+        if not self.error_bucket.consume():
+            self.errors_suppressed += 1
+            errors_suppressed.inc()
+            return
+
+        header_size = len(datagram) - len(payload)
+        message = make_icmp(type, code, rest, datagram[:(header_size + 8)])
+        errors_sent.inc()
+        self.network.send(message, src_addr, IPPROTO_ICMP)
+
+    def time_exceeded(self, datagram, code=ICMP_EXC_TTL):
+        self.send_error(ICMP_TIME_EXCEEDED, code, datagram)
+
+    def destination_unreachable(self, datagram, code):
+        self.send_error(ICMP_DEST_UNREACH, code, datagram)
+
+    def fragmentation_needed(self, datagram, next_hop_mtu):
+        self.send_error(ICMP_DEST_UNREACH, ICMP_FRAG_NEEDED, datagram, next_hop_mtu & 0xffff)
@@ -5,6 +5,21 @@ from random import randint
 
 from utils.ip import *
 from utils.tcp import *
+from utils.icmp import *
+from network_layer.icmp import ICMP
+from network_layer.reassembly import Reassembler
+from utils.metrics import REGISTRY
+from utils.trace import boundary
+
+datagrams_delivered = REGISTRY.counter('ip_datagrams_delivered_total', 'Datagrams delivered to a protocol of this host')
+datagrams_sent = REGISTRY.counter('ip_datagrams_sent_total', 'Datagrams sent by this host')
+datagrams_forwarded = REGISTRY.counter('ip_datagrams_forwarded_total', 'Datagrams forwarded as a router')
+fragments_sent = REGISTRY.counter('ip_fragments_sent_total', 'Fragments sent, forwarded ones included')
+fragments_received = REGISTRY.counter('ip_fragments_received_total', 'Fragments addressed to this host')
+no_route = REGISTRY.counter('ip_datagrams_dropped_total', 'Datagrams dropped', reason='no_route')
+ttl_expired = REGISTRY.counter('ip_datagrams_dropped_total', 'Datagrams dropped', reason='ttl_expired')
+too_big = REGISTRY.counter('ip_datagrams_dropped_total', 'Datagrams dropped', reason='too_big')
+unknown_protocol = REGISTRY.counter('ip_datagrams_dropped_total', 'Datagrams dropped', reason='unknown_protocol')
 
 class IP:
     def __init__(self, link):
@@ -12,50 +27,75 @@ class IP:
         Initiate network layer. The argument is a link layer implementation
         capable of finding the next_hops.
         """
-        self.callback = None
+        self.protocols = {}
         self.link = link
         self.link.register_receiver(self.__raw_recv)
         self.ignore_checksum = self.link.ignore_checksum
+        self.mtu = self.link.mtu
         self.my_address = None
         self.identification = randint(0, 2**16 - 1)
+        self.icmp = ICMP(self)
+        self.reassembler = Reassembler(self)
 
+    @boundary('ip')
     def __raw_recv(self, datagram):
-        _, _, _, _, _, ttl, proto, \
+        _, _, _, flags, frag_offset, ttl, proto, \
            src_addr, dst_addr, payload = read_ipv4_header(datagram)
         if dst_addr == self.my_address:
             # acts as host
-            if proto == IPPROTO_TCP and self.callback:
-                self.callback(src_addr, dst_addr, payload)
+            if (flags & IP_FLAG_MF) or frag_offset != 0:
+                fragments_received.inc()
+                datagram = self.reassembler.add(datagram)
+                if datagram is None:
+                    return
+                payload = read_ipv4_header(datagram)[-1]
+
+            handler = self.protocols.get(proto)
+            if handler is not None:
+                datagrams_delivered.inc()
+                handler(src_addr, dst_addr, payload)
+            else:
+                unknown_protocol.inc()
+                self.icmp.destination_unreachable(datagram, ICMP_PROT_UNREACH)
         else:
             # acts as router
             next_hop = self._next_hop(dst_addr)
             new_ttl = ttl - 1
             header_size = len(datagram) - len(payload)
 
-            if new_ttl > 0:
+            if next_hop is None:
+                no_route.inc()
+                self.icmp.destination_unreachable(datagram, ICMP_NET_UNREACH)
+            elif new_ttl <= 0:
+                ttl_expired.inc()
+                self.icmp.time_exceeded(datagram)
+            elif len(datagram) > self.mtu and (flags & IP_FLAG_DF):
+                too_big.inc()
+                self.icmp.fragmentation_needed(datagram, self.mtu)
+            else:
+                datagrams_forwarded.inc()
                 datagram = bytearray(datagram)
                 datagram[8:9] = struct.pack('!B', new_ttl)
                 datagram[10:12] = b'\x00\x00'
 
                 new_header = self._fix_ipv4_checksum(bytes(datagram[:header_size]))
-                self.link.send(new_header + payload, next_hop)
-            else:
-                # Time exceeded
-                icmp_header = self._assemble_icmp_header(11, 0, 0)
-                return_segment = icmp_header + datagram[:(header_size + 8)]
-                ipv4_header = self._assemble_ipv4_header(
-                    src_addr, 
-                    len(return_segment),
-                    IPPROTO_ICMP,
-                    64
-                )
-                return_hop = self._next_hop(src_addr)
-                self.link.send(ipv4_header + return_segment, return_hop)
+                if len(datagram) > self.mtu:
+                    self._send_fragmented(new_header, payload, next_hop, self.mtu)
+                else:
+                    self.link.send(new_header + payload, next_hop)
 
+    @boundary('ip')
     def _next_hop(self, dest_addr):
         ip = self._ipaddr_to_bitstring(dest_addr)
         return self._routing_table.find(ip)
 
+    def path_mtu(self, dest_addr):
+        """
+        Largest datagram that should be sent to dest_addr, taking into
+        account what ICMP learned from Fragmentation Needed messages.
+        """
+        return self.icmp.path_mtu(dest_addr)
+
     def define_host_address(self, my_address):
         """
         Define this host's IPv4 address ('x.y.z.w' string). Datagrams
@@ -83,29 +123,76 @@ class IP:
         Registra uma função para ser chamada quando dados vierem da camada de rede
         """
         """
-        Register a function to be called when data arrives from network layer.
+        Register a function to be called when TCP data arrives from network layer.
+        """
+        self.register_protocol_handler(IPPROTO_TCP, callback)
+
+    def register_protocol_handler(self, protocol, callback):
+        """
+        Register a function to be called when a datagram carrying the given
+        IP protocol number (IPPROTO_TCP, IPPROTO_ICMP, ...) arrives for this
+        host. The callback receives (src_addr, dst_addr, payload).
         """
-        self.callback = callback
+        self.protocols[protocol] = callback
 
-    def send(self, segment, dest_addr):
+    @boundary('ip')
+    def send(self, segment, dest_addr, protocol=IPPROTO_TCP):
         """
         Send segment to dest_addr, an IPv4 address string of the form
         'x.y.z.w'.
         """
         next_hop = self._next_hop(dest_addr)
+        mtu = self.path_mtu(dest_addr)
 
         dest_addr = int.from_bytes(ip_address(dest_addr).packed, 'big')
         header = self._assemble_ipv4_header(
             dest_addr,
             len(segment), 
-            IPPROTO_TCP,
-            64
+            protocol,
+            64,
+            # Routers must report a too small MTU instead of fragmenting
+            # TCP segments, for path MTU discovery (RFC 1191)
+            IP_FLAG_DF if protocol == IPPROTO_TCP else 0
         )
 
-        datagram = header + segment
-        self.link.send(datagram, next_hop)
+        datagrams_sent.inc()
+        if len(header) + len(segment) <= mtu:
+            datagram = header + segment
+            self.link.send(datagram, next_hop)
+        else:
+            self._send_fragmented(header, segment, next_hop, mtu)
         self.identification = (self.identification + 1) % (2**16)
 
+    def _send_fragmented(self, header, payload, next_hop, mtu):
+        """
+        Send a datagram, given as its header and payload, in as many
+        fragments as needed to fit in mtu. The payload is sliced through a
+        memoryview, so no intermediate copies of it are made.
+        """
+        header = bytearray(header)
+        header_size = len(header)
+        flags__fragment_offset, = struct.unpack('!H', header[6:8])
+        base_offset = flags__fragment_offset & 0x1fff
+        # Fragmenting a fragment: the last piece keeps the original MF flag.
+        # DF is dropped, the datagram was already larger than the path MTU
+        # when a lower one was learned
+        more_fragments = flags__fragment_offset & (IP_FLAG_MF << 13)
+
+        fragment_size = (mtu - header_size) // 8 * 8
+        payload = memoryview(payload)
+        for start in range(0, len(payload), fragment_size):
+            fragment = payload[start:start + fragment_size]
+            if start + fragment_size < len(payload):
+                flags = IP_FLAG_MF << 13
+            else:
+                flags = more_fragments
+
+            header[2:4] = struct.pack('!H', header_size + len(fragment))
+            header[6:8] = struct.pack('!H', flags | (base_offset + start // 8))
+            header[10:12] = b'\x00\x00'
+            fragments_sent.inc()
+            self.link.send(self._fix_ipv4_checksum(header) + fragment, next_hop)
+
     def _cidr_to_bitstring(self, cidr):
         ip, bits = cidr.split('/')
         bits = int(bits)
@@ -124,18 +211,12 @@ class IP:
         header[10:12] = struct.pack('!H', header_checksum)
         return bytes(header)
     
-    def _fix_icmp_checksum(self, header):
-        header_checksum = calc_checksum(header)
-        header = bytearray(header)
-        header[2:4] = struct.pack('!H', header_checksum)
-        return bytes(header)
-    
-    def _assemble_ipv4_header(self, dest_addr, payload_size, protocol, ttl=64):
+    def _assemble_ipv4_header(self, dest_addr, payload_size, protocol, ttl=64, flags=0):
         version__ihl = (4 << 4) + 5
         dscp__ecn = 0
         total_length = 20 + payload_size
         identification = self.identification
-        flags__fragment_offset = 0
+        flags__fragment_offset = flags << 13
         header_checksum = 0
         src_addr = int.from_bytes(ip_address(self.my_address).packed, 'big')
         dest_addr = int.from_bytes(ip_address(dest_addr).packed, 'big')
@@ -155,16 +236,6 @@ class IP:
         )
         return self._fix_ipv4_checksum(header)
     
-    def _assemble_icmp_header(self, type, code, rest):
-        header = struct.pack(
-            '!BBHI',
-            type,
-            code,
-            0, # Checksum,
-            rest,
-        )
-        return self._fix_icmp_checksum(header)
-
 
 # TRIE implementation for routing table
 class TRIE:
@@ -0,0 +1,147 @@
+import asyncio
+import struct
+from bisect import insort
+from collections import OrderedDict
+
+from utils.ip import *
+from utils.icmp import ICMP_EXC_FRAGTIME
+from utils.metrics import REGISTRY
+
+REASSEMBLY_TIMEOUT = 30            # Seconds a datagram may wait for its fragments
+REASSEMBLY_MEMORY = 256 * 1024     # Bytes held by all incomplete datagrams
+MAX_DATAGRAM_SIZE = 2**16 - 1
+
+datagrams_reassembled = REGISTRY.counter('ip_datagrams_reassembled_total', 'Datagrams rebuilt from their fragments')
+reassembly_timeouts = REGISTRY.counter('ip_reassembly_dropped_total', 'Incomplete datagrams dropped', reason='timeout')
+reassembly_evictions = REGISTRY.counter('ip_reassembly_dropped_total', 'Incomplete datagrams dropped', reason='memory')
+
+class PartialDatagram:
+    __slots__ = ('header', 'first_fragment', 'buffer', 'intervals',
+                 'total_length', 'expires')
+
+    def __init__(self, expires):
+        self.header = None
+        self.first_fragment = None
+        self.buffer = bytearray()
+        self.intervals = []
+        self.total_length = None
+        self.expires = expires
+
+    def add_interval(self, start, end):
+        """
+        Record that bytes [start, end) were received, merging the interval
+        with the ones it overlaps or touches.
+        """
+        insort(self.intervals, (start, end))
+        merged = []
+        for start, end in self.intervals:
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        self.intervals = merged
+
+    def complete(self):
+        return self.header is not None and self.total_length is not None and \
+            self.intervals == [(0, self.total_length)]
+
+
+class Reassembler:
+    def __init__(self, network, timeout=REASSEMBLY_TIMEOUT, memory_limit=REASSEMBLY_MEMORY):
+        """
+        Reassemble fragmented datagrams addressed to this host. Incomplete
+        datagrams are indexed by (src, dst, identification, protocol), are
+        dropped after timeout seconds, and the oldest ones are evicted when
+        their buffers exceed memory_limit bytes in total.
+        """
+        self.network = network
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.memory = 0
+        self.pending = OrderedDict()
+        self.timer = None
+
+    def add(self, datagram):
+        """
+        Add a fragment. Returns the reassembled datagram once every
+        fragment has arrived, None otherwise.
+        """
+        _, _, identification, flags, frag_offset, _, proto, \
+            src_addr, dst_addr, payload = read_ipv4_header(datagram)
+        more_fragments = flags & IP_FLAG_MF
+        start = frag_offset * 8
+        end = start + len(payload)
+        header_size = len(datagram) - len(payload)
+
+        if end + header_size > MAX_DATAGRAM_SIZE or \
+           (more_fragments and (len(payload) == 0 or len(payload) % 8 != 0)):
+            return None
+
+        loop = asyncio.get_event_loop()
+        self._expire(loop.time())
+
+        key = (src_addr, dst_addr, identification, proto)
+        partial = self.pending.get(key)
+        if partial is None:
+            partial = self.pending[key] = PartialDatagram(loop.time() + self.timeout)
+            if self.timer is None:
+                self.timer = loop.call_later(self.timeout, self._expire_timer)
+
+        if not more_fragments:
+            if partial.total_length is not None and partial.total_length != end:
+                self._drop(key)
+                return None
+            partial.total_length = end
+        if start == 0:
+            partial.header = datagram[:header_size]
+            partial.first_fragment = datagram[:header_size + 8]
+
+        if len(partial.buffer) < end:
+            self.memory += end - len(partial.buffer)
+            partial.buffer.extend(bytes(end - len(partial.buffer)))
+        partial.buffer[start:end] = payload
+        partial.add_interval(start, end)
+
+        if partial.complete():
+            self._drop(key)
+            datagrams_reassembled.inc()
+            return self._rebuild(partial)
+
+        while self.memory > self.memory_limit:
+            # Oldest datagrams are the first ones in insertion order
+            self._drop(next(iter(self.pending)))
+            reassembly_evictions.inc()
+        return None
+
+    def _rebuild(self, partial):
+        header = bytearray(partial.header)
+        header[2:4] = struct.pack('!H', len(header) + partial.total_length)
+        header[6:8] = b'\x00\x00'
+        header[10:12] = b'\x00\x00'
+        header[10:12] = struct.pack('!H', calc_checksum(header))
+        return bytes(header) + bytes(partial.buffer[:partial.total_length])
+
+    def _drop(self, key):
+        partial = self.pending.pop(key)
+        self.memory -= len(partial.buffer)
+        return partial
+
+    def _expire(self, now):
+        while self.pending:
+            key = next(iter(self.pending))
+            if self.pending[key].expires > now:
+                break
+
+            partial = self._drop(key)
+            reassembly_timeouts.inc()
+            if partial.first_fragment is not None:
+                self.network.icmp.time_exceeded(partial.first_fragment, ICMP_EXC_FRAGTIME)
+
+    def _expire_timer(self):
+        loop = asyncio.get_event_loop()
+        self.timer = None
+        self._expire(loop.time())
+        if self.pending:
+            oldest = next(iter(self.pending.values()))
+            self.timer = loop.call_later(max(0, oldest.expires - loop.time()), self._expire_timer)
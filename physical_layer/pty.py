@@ -3,6 +3,13 @@ import errno
 import fcntl
 import termios
 import asyncio
+from time import perf_counter
+
+import utils.metrics as metrics
+from utils.trace import boundary
+
+bytes_read = metrics.REGISTRY.counter('pty_read_bytes_total', 'Bytes read from the serial line')
+bytes_written = metrics.REGISTRY.counter('pty_written_bytes_total', 'Bytes written to the serial line')
 
 class PTY:
     def __init__(self):
@@ -28,11 +35,18 @@ class PTY:
         self.pty_name = pty_name
         asyncio.get_event_loop().add_reader(pty, self.__raw_recv)
 
+    @boundary('pty')
     def __raw_recv(self):
         try:
             data = os.read(self.pty, 2048)
+            bytes_read.inc(len(data))
             if self.callback:
-                self.callback(data)
+                # Lets the stack measure the time until data gets to the application
+                metrics.rx_time = perf_counter()
+                try:
+                    self.callback(data)
+                finally:
+                    metrics.rx_time = None
         except OSError as e:
             if e.errno == errno.EIO:
                 pass      # other end is closed
@@ -49,5 +63,6 @@ class PTY:
         """
         Send data to serial line
         """
+        bytes_written.inc(len(data))
         os.write(self.pty, data)
 
@@ -0,0 +1,119 @@
+import struct
+import random
+import asyncio
+
+# Recording of the traffic of a serial line, to replay it later through the
+# same stack. The file starts with a header, MAGIC, VERSION and the seed
+# of the random module (unsigned 8 bytes), followed by one record per chunk
+# of bytes read or written:
+#
+#   varint: microseconds since the previous record << 1 | direction
+#   varint: length of the chunk
+#   the chunk
+#
+# varints are little-endian base 128, as in protobuf. An empty outbound
+# chunk marks the time the recording was closed.
+
+MAGIC = b'SCSR'
+VERSION = 1
+INBOUND = 0
+OUTBOUND = 1
+
+class RecordingLine:
+    def __init__(self, serial_line, path, seed=None):
+        """
+        Wrap serial_line, a PTY or another object implementing
+        register_receiver and send, recording to path every chunk read from
+        it or written to it. The random module is seeded with seed (a
+        random one by default), which is recorded too, so that a replay
+        makes the same choices (IP identifications, TCP sequence numbers).
+        Must therefore be created before the rest of the stack.
+        """
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        random.seed(seed)
+        self.seed = seed
+        self.serial_line = serial_line
+        self.callback = None
+        self.loop = asyncio.get_event_loop()
+        self.start = self.loop.time()
+        self.last = 0
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + struct.pack('!BQ', VERSION, seed))
+        self.serial_line.register_receiver(self._receive)
+
+    def _record(self, direction, data):
+        if self.file.closed:
+            return
+        now = round((self.loop.time() - self.start) * 1e6)
+        self.file.write(_varint((now - self.last) << 1 | direction) + _varint(len(data)))
+        self.file.write(data)
+        self.last = now
+
+    def _receive(self, data):
+        self._record(INBOUND, data)
+        if self.callback:
+            self.callback(data)
+
+    def register_receiver(self, callback):
+        """
+        Register a function to be called when data arrives from serial line
+        """
+        self.callback = callback
+
+    def send(self, data):
+        """
+        Send data to serial line
+        """
+        self._record(OUTBOUND, data)
+        self.serial_line.send(data)
+
+    def close(self):
+        self._record(OUTBOUND, b'')
+        self.file.close()
+
+
+def read_recording(path):
+    """
+    Read a file written by RecordingLine. Returns the seed and the list of
+    records as (seconds since the start, direction, chunk).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != MAGIC:
+        raise ValueError(f'{path} is not a recording')
+    version, seed = struct.unpack_from('!BQ', data, 4)
+    if version != VERSION:
+        raise ValueError(f'unknown recording version {version}')
+
+    records = []
+    pos = 4 + struct.calcsize('!BQ')
+    now = 0
+    while pos < len(data):
+        delta, pos = _read_varint(data, pos)
+        size, pos = _read_varint(data, pos)
+        now += delta >> 1
+        records.append((now / 1e6, delta & 1, data[pos:pos + size]))
+        pos += size
+    return seed, records
+
+
+def _varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
@@ -0,0 +1,106 @@
+import asyncio
+import random
+from collections import deque
+
+BITS_PER_BYTE = 10      # 8N1: start bit, 8 data bits and stop bit
+REORDER_DELAY = 0.01    # Seconds a reordered chunk is held back
+
+class VirtualWire:
+    def __init__(self, bandwidth=None, latency=0, jitter=0, loss=0, reorder=0,
+                 reorder_delay=REORDER_DELAY, seed=None):
+        """
+        In-memory serial wire between two ends, ends[0] and ends[1], each
+        one usable in place of a PTY. Every chunk of bytes sent through an
+        end is one unit of transmission: it takes len(chunk) *
+        BITS_PER_BYTE / bandwidth seconds to get on the wire (bandwidth in
+        bits per second, None for no limit), then latency seconds plus a
+        random delay of up to jitter seconds to get to the other end.
+        Chunks are lost with probability loss, and held back reorder_delay
+        more seconds with probability reorder, being overtaken by the next
+        ones. Otherwise chunks arrive in the order they were sent. seed
+        makes the losses and delays reproducible.
+        """
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.loop = asyncio.get_event_loop()
+        self.ends = (VirtualSerialLine(self, 0), VirtualSerialLine(self, 1))
+        # Per direction, from ends[0] and from ends[1]
+        self.busy_until = [0, 0]
+        self.last_arrival = [0, 0]
+        self.in_flight = (deque(), deque())
+        self.timers = [None, None]
+        self.chunks_lost = 0
+        self.chunks_reordered = 0
+
+    def _transmit(self, direction, data):
+        now = self.loop.time()
+        arrival = now
+        if self.bandwidth is not None:
+            start = max(now, self.busy_until[direction])
+            arrival = self.busy_until[direction] = \
+                start + len(data) * BITS_PER_BYTE / self.bandwidth
+
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.chunks_lost += 1
+            return
+        arrival += self.latency
+        if self.jitter > 0:
+            arrival += self.jitter * self.random.random()
+
+        if self.reorder > 0 and self.random.random() < self.reorder:
+            self.chunks_reordered += 1
+            self.loop.call_at(arrival + self.reorder_delay, self.ends[1 - direction]._receive, data)
+            return
+
+        # Jitter never reorders chunks, they are delivered from a queue
+        arrival = max(arrival, self.last_arrival[direction])
+        self.last_arrival[direction] = arrival
+        self.in_flight[direction].append((arrival, data))
+        if self.timers[direction] is None:
+            self.timers[direction] = self.loop.call_at(arrival, self._deliver, direction)
+
+    def _deliver(self, direction):
+        in_flight = self.in_flight[direction]
+        receiver = self.ends[1 - direction]
+        now = self.loop.time()
+        # The timer was set for the first chunk
+        _, data = in_flight.popleft()
+        receiver._receive(data)
+        while in_flight and in_flight[0][0] <= now:
+            receiver._receive(in_flight.popleft()[1])
+
+        if in_flight:
+            self.timers[direction] = self.loop.call_at(in_flight[0][0], self._deliver, direction)
+        else:
+            self.timers[direction] = None
+
+
+class VirtualSerialLine:
+    def __init__(self, wire, direction):
+        """
+        One end of a VirtualWire, with the interface of PTY.
+        """
+        self.wire = wire
+        self.direction = direction
+        self.callback = None
+
+    def _receive(self, data):
+        if self.callback:
+            self.callback(data)
+
+    def register_receiver(self, callback):
+        """
+        Register a function to be called when data arrives from serial line
+        """
+        self.callback = callback
+
+    def send(self, data):
+        """
+        Send data to serial line
+        """
+        self.wire._transmit(self.direction, data)
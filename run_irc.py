@@ -1,32 +1,91 @@
+import atexit
+import signal
+import asyncio
+import logging
+
+from utils.log import setup_logging
+from utils.metrics import export_periodically
+from utils import trace
 from physical_layer.pty import PTY
-from link_layer.slip import SLIP
+from physical_layer.recorder import RecordingLine
+from link_layer.slip import SLIP, MODE_SLIP
 from network_layer.ip import IP
 from transport_layer.tcp import TCPServer
 from application_layer.irc import IRCServer
+from application_layer.irc_cluster import ShardedIRCServer
 
-def main():
-    this_end = '192.168.123.2'
-    other_end = '192.168.123.1'
-
-    serial_line = PTY()
+THIS_END = '192.168.123.2'
+OTHER_END = '192.168.123.1'
 
-    link = SLIP({other_end: serial_line})
+def build_server(serial_line, link_mode=MODE_SLIP, irc_workers=0):
+    """
+    Build the stack over serial_line, up to the IRC server listening on
+    port 7000. Returns the link layer and the IRC server.
+    """
+    link = SLIP({OTHER_END: serial_line}, link_mode)
 
     network = IP(link)
-    network.define_host_address(this_end)
+    network.define_host_address(THIS_END)
     network.define_routing_table([
-        ('0.0.0.0/0', other_end)
+        ('0.0.0.0/0', OTHER_END)
     ])
 
     tcp_server = TCPServer(network, 7000)
 
-    irc_server = IRCServer(tcp_server)
+    if irc_workers > 0:
+        irc_server = ShardedIRCServer(tcp_server, irc_workers)
+    else:
+        irc_server = IRCServer(tcp_server)
+    return link, irc_server
+
+def main():
+    # MODE_CSLIP compresses TCP/IP headers, use 'slattach -p cslip' with it
+    link_mode = MODE_SLIP
+    # Number of processes sharing the IRC clients, 0 keeps them in this one
+    irc_workers = 0
+    # logging.DEBUG also logs every IRC message received
+    log_level = logging.INFO
+    # Prometheus text file the metrics are written to every 15 seconds
+    metrics_file = None
+    # Chrome trace of the calls between layers, written when the server stops
+    trace_file = None
+    # pcap file written while capturing, capture is toggled with SIGUSR1
+    capture_file = None
+    # Traffic of the serial line is recorded there, to be replayed with
+    # benchmarks/replay.py (requires irc_workers = 0)
+    record_file = None
+
+    setup_logging(log_level)
+    if trace_file is not None:
+        # Must be done before building the stack
+        trace.enable()
+        atexit.register(trace.write_chrome_trace, trace_file)
+        atexit.register(trace.write_folded, trace_file + '.folded')
+
+    pty = serial_line = PTY()
+    if record_file is not None:
+        # Must be done before building the stack, which is then seeded
+        serial_line = RecordingLine(pty, record_file)
+        atexit.register(serial_line.close)
+
+    link, irc_server = build_server(serial_line, link_mode, irc_workers)
+
+    if capture_file is not None:
+        def toggle_capture():
+            if link.capture is None:
+                link.start_capture(capture_file)
+            else:
+                link.stop_capture()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, toggle_capture)
+
+    if metrics_file is not None:
+        export_periodically(metrics_file, 15)
 
     print('To connect to the other end of the physical layer, execute:')
-    print('  sudo slattach -v -p slip {}'.format(serial_line.pty_name))
-    print('  sudo ifconfig sl0 {} pointopoint {}'.format(other_end, this_end))
+    print('  sudo slattach -v -p {} {}'.format(link_mode, pty.pty_name))
+    print('  sudo ifconfig sl0 {} pointopoint {}'.format(OTHER_END, THIS_END))
     print()
-    print('Service will be available at address {}'.format(this_end))
+    print('Service will be available at address {}'.format(THIS_END))
     print()
 
     irc_server.run()
@@ -1,15 +1,58 @@
+import struct
 import asyncio
+import logging
 from random import randint
-from time import time
 from utils.tcp import *
+from utils.ip import IPPROTO_TCP
+from utils.metrics import REGISTRY, observe_rx_latency
+from utils.trace import boundary
+
+logger = logging.getLogger(__name__)
+
+segments_received = REGISTRY.counter('tcp_segments_received_total', 'Segments received for this server')
+segments_sent = REGISTRY.counter('tcp_segments_sent_total', 'Segments sent, retransmissions excluded')
+retransmissions = REGISTRY.counter('tcp_retransmissions_total', 'Segments retransmitted on timeout')
+bad_checksums = REGISTRY.counter('tcp_segments_dropped_total', 'Segments dropped', reason='checksum')
+unknown_connections = REGISTRY.counter('tcp_segments_dropped_total', 'Segments dropped', reason='unknown_connection')
+connections_accepted = REGISTRY.counter('tcp_connections_accepted_total', 'Connections accepted')
+connections_aborted = REGISTRY.counter('tcp_connections_aborted_total', 'Connections reset by the application')
+rtt_samples = REGISTRY.histogram('tcp_rtt_seconds', 'Round-trip time samples')
+window_sizes = REGISTRY.histogram('tcp_congestion_window_segments', 'Congestion window after each change',
+                                  buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
 
 class TCPServer:
-    def __init__(self, network, port):
+    def __init__(self, network, port=None):
+        """
+        Instantiate the transport layer. The server may listen on any number
+        of ports: port is an optional first one, others are added with listen.
+        Segments addressed to every listening port are demultiplexed by this
+        single object.
+        """
         self.network = network
-        self.port = port
+        self.listeners = {}
         self.connections = {}
         self.callback = None
         self.network.register_receiver(self._rdt_rcv)
+        self.network.icmp.register_quote_check(IPPROTO_TCP, self._segment_in_flight)
+        REGISTRY.gauge('tcp_connections', 'Open connections',
+                       function=lambda server: len(server.connections), owner=self)
+        if port is not None:
+            self.listen(port)
+
+    def listen(self, port, callback=None):
+        """
+        Start accepting connections on port. New connections are reported to
+        callback, or to the monitor registered with
+        register_accepted_connections_monitor if callback is None.
+        """
+        self.listeners[port] = callback
+
+    def unlisten(self, port):
+        """
+        Stop accepting new connections on port. Established connections are
+        left untouched.
+        """
+        self.listeners.pop(port, None)
 
     def register_accepted_connections_monitor(self, callback):
         """
@@ -18,56 +61,121 @@ class TCPServer:
         """
         self.callback = callback
 
+    @boundary('tcp')
     def _rdt_rcv(self, src_addr, dst_addr, segment):
         src_port, dst_port, seq_no, ack_no, \
             flags, window_size, _, _ = read_header(segment)
 
-        if dst_port != self.port:
-            # Ignore segments not sent to this server's port
+        key = flow_key(src_addr, src_port, dst_addr, dst_port)
+        connection = self.connections.get(key)
+        listening = dst_port in self.listeners
+
+        if connection is None and not listening:
+            # Ignore segments not sent to one of this server's ports
             return
+        segments_received.inc()
         if not self.network.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
-            print('discarding segment with incorrect checksum')
+            bad_checksums.inc()
+            logger.warning('Discarding segment from %s:%d with incorrect checksum', src_addr, src_port)
             return
 
         payload = segment[4*(flags>>12):]
-        connection_id = (src_addr, src_port, dst_addr, dst_port)
 
-        if (flags & FLAGS_SYN) == FLAGS_SYN:
+        if (flags & FLAGS_SYN) == FLAGS_SYN and listening:
             # SYN flag set, client establishing newconnection
-            conexao = self.connections[connection_id] = \
+            connection_id = (src_addr, src_port, dst_addr, dst_port)
+            connections_accepted.inc()
+            conexao = self.connections[key] = \
                 Connection(self, connection_id, seq_no, window_size)
 
-            if self.callback:
-                self.callback(conexao)
-        elif connection_id in self.connections:
+            callback = self.listeners[dst_port] or self.callback
+            if callback:
+                callback(conexao)
+        elif connection is not None:
             # Sends packet to correct connection
-            self.connections[connection_id]._rdt_rcv(seq_no, ack_no, flags, payload)
+            connection._rdt_rcv(seq_no, ack_no, flags, payload)
         else:
-            print('%s:%d -> %s:%d (packet addressed to unknown connection)' %
-                  (src_addr, src_port, dst_addr, dst_port))
+            unknown_connections.inc()
+            logger.info('%s:%d -> %s:%d (packet addressed to unknown connection)',
+                        src_addr, src_port, dst_addr, dst_port)
             
+    def connect(self, dst_addr, dst_port, callback=None, src_port=None):
+        """
+        Open a connection to dst_addr:dst_port from src_port, by default a
+        free port chosen at random. Returns the Connection at once: data
+        sent through it is queued until the other end answers, and then
+        callback is called with it.
+        """
+        src_addr = self.network.my_address
+        while src_port is None:
+            src_port = randint(49152, 65535)
+            if src_port in self.listeners or \
+               flow_key(dst_addr, dst_port, src_addr, src_port) in self.connections:
+                src_port = None
+
+        connection_id = (dst_addr, dst_port, src_addr, src_port)
+        connection = self.connections[flow_key(*connection_id)] = \
+            Connection(self, connection_id, None, 0, callback)
+        return connection
+
+    def _segment_in_flight(self, dst_addr, header):
+        # Beginning of a segment quoted by an ICMP error: it must belong to
+        # a connection and be sent but not yet acknowledged
+        src_port, dst_port, seq_no = struct.unpack('!HHI', header)
+        connection = self.connections.get(flow_key(dst_addr, dst_port, self.network.my_address, src_port))
+        return connection is not None and \
+            connection.last_acked_no <= seq_no < connection.current_seq_no
+
     def remove_connection(self, connection_id):
-        self.connections.pop(connection_id, None)
+        self.connections.pop(flow_key(*connection_id), None)
 
 ALPHA = 0.125
 BETA = 0.25
+MIN_TIMEOUT = 0.2  # Seconds, as Linux's minimum RTO
+OUT_OF_ORDER_BYTES = 64 * 1024  # Data received ahead of a missing segment that is kept
 class Connection:
-    def __init__(self, tcp_server, connection_id, seq_no, window_size):
+    def __init__(self, tcp_server, connection_id, seq_no, window_size, connected_callback=None):
+        """
+        Connection with the other end of connection_id, given as (remote
+        address, remote port, local address, local port). A connection
+        opened by the other end, whose SYN carried seq_no, is answered at
+        once. If seq_no is None, the connection is opened from this end and
+        connected_callback is called when the other end answers.
+        """
         self.server = tcp_server
         self.connection_id = connection_id
         self.callback = None
         self.timer = None
         self.unacked_segments = []
         self.sending_queue = []
+        self.queued_bytes = 0
         self.estimated_rtt = None
         self.dev_rtt = None
         self.current_window_size = 1 # * MSS
         self.current_seq_no = randint(0, 0xffff)
         self.last_acked_no = self.current_seq_no
-        self.expected_seq_no = seq_no + 1
         self.ready_to_close = False
         self.handshake_complete = False
+        self.aborted = False
+        self.syn_sent = False
+        self.connected_callback = connected_callback
+        # seq_no: payload of segments received ahead of expected_seq_no
+        self.out_of_order = {}
+        self.out_of_order_bytes = 0
+        # seq_no of a FIN received ahead of expected_seq_no
+        self.fin_seq_no = None
+
+        if seq_no is None:
+            # Active open, nothing else is sent before the SYN is answered
+            self.expected_seq_no = 0
+            self._send_segment(
+                FLAGS_SYN,
+                b'',
+            )
+            self.syn_sent = True
+            return
 
+        self.expected_seq_no = seq_no + 1
         # Responde com SYNACK para a abertura de conexão
         # Respond with SYNACK to connection opening
         self._send_segment(
@@ -85,7 +193,7 @@ class Connection:
         if self.estimated_rtt is None:
             return 3
         else:
-            return self.estimated_rtt + 4 * self.dev_rtt
+            return max(MIN_TIMEOUT, self.estimated_rtt + 4 * self.dev_rtt)
         
     def _estimate_rtt(self, sample_rtt):
         """
@@ -97,6 +205,7 @@ class Connection:
             self.handshake_complete = True
             return
 
+        rtt_samples.observe(sample_rtt)
         if self.estimated_rtt is None:
             self.estimated_rtt = sample_rtt
             self.dev_rtt = sample_rtt / 2
@@ -105,14 +214,27 @@ class Connection:
             self.dev_rtt = (1-BETA) * self.dev_rtt + BETA * abs(sample_rtt - self.estimated_rtt)
 
     def _rdt_rcv(self, seq_no, ack_no, flags, payload):
-        # Connection closing
+        if self.syn_sent:
+            # Only the SYNACK answering our SYN is expected
+            if (flags & (FLAGS_SYN | FLAGS_ACK)) == (FLAGS_SYN | FLAGS_ACK) and \
+               ack_no == self.last_acked_no + 1:
+                self._connected(seq_no, ack_no)
+            return
+
+        # Connection closing, once everything sent before the FIN arrived
         if (flags & FLAGS_FIN) == FLAGS_FIN:
-            self.expected_seq_no += 1
+            if seq_no == self.expected_seq_no:
+                self._fin_received()
+                return
+            if seq_no > self.expected_seq_no:
+                # It overtook data, as on bonded links: kept until the data
+                # arrives, and the data still missing is acknowledged
+                self.fin_seq_no = seq_no
+            # A retransmitted FIN is only acknowledged again
             self._send_segment(
                 FLAGS_ACK,
                 b''
             )
-            self.callback(self, b'')
             return
 
         # An ACK
@@ -127,6 +249,7 @@ class Connection:
                 # Adjusts window size with new ACK
                 if self.handshake_complete:
                     self.current_window_size += 1
+                    window_sizes.observe(self.current_window_size)
 
                 # Verifica se algum dos pacotes enviados
                 # ainda não foi reconhecido
@@ -143,7 +266,7 @@ class Connection:
                     if not self.unacked_segments[-1][3]:
                         # A non-retransmitted packet has been acknowledged,
                         # RTT must be estimated again
-                        self._estimate_rtt(time() - self.unacked_segments[-1][2])
+                        self._estimate_rtt(asyncio.get_event_loop().time() - self.unacked_segments[-1][2])
 
                     self.unacked_segments = []
                 else:
@@ -151,7 +274,7 @@ class Connection:
                     if i > 0 and not self.unacked_segments[i-1][3]:
                         # A non-retransmitted packet has been acknowledged,
                         # RTT must be estimated again
-                        self._estimate_rtt(time() - self.unacked_segments[i-1][2])
+                        self._estimate_rtt(asyncio.get_event_loop().time() - self.unacked_segments[i-1][2])
 
                     self.unacked_segments = self.unacked_segments[i:]
                     self.timer = asyncio.get_event_loop().call_later(self._timeout_interval(), self._resend_timer)
@@ -171,12 +294,76 @@ class Connection:
         if seq_no == self.expected_seq_no:
             self.expected_seq_no += len(payload)
             if payload != b'':
+                observe_rx_latency()
                 self.callback(self, payload)
+                # The application may have aborted the connection meanwhile
+                if self.aborted:
+                    return
+            if self.out_of_order:
+                self._deliver_out_of_order()
+                if self.aborted:
+                    return
+            if self.fin_seq_no == self.expected_seq_no:
+                self._fin_received()
+                return
+        elif seq_no > self.expected_seq_no and len(payload) > 0 and seq_no not in self.out_of_order \
+             and self.out_of_order_bytes + len(payload) <= OUT_OF_ORDER_BYTES:
+            # Kept until the missing segments arrive, as with bonded links
+            # datagrams may overtake each other
+            self.out_of_order[seq_no] = payload
+            self.out_of_order_bytes += len(payload)
+
+        self._send_segment(
+            FLAGS_ACK,
+            b'',
+        )
 
+    def _connected(self, seq_no, ack_no):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.syn_sent = False
+        self.handshake_complete = True
+        self.expected_seq_no = seq_no + 1
+        self.last_acked_no = ack_no
+        self.unacked_segments = []
+
+        # Acknowledges the SYNACK, along with the data queued meanwhile
         self._send_segment(
             FLAGS_ACK,
             b'',
         )
+        if self.connected_callback:
+            self.connected_callback(self)
+
+    def _fin_received(self):
+        self.fin_seq_no = None
+        self.expected_seq_no += 1
+        self._send_segment(
+            FLAGS_ACK,
+            b''
+        )
+        self.callback(self, b'')
+
+    def _deliver_out_of_order(self):
+        while self.expected_seq_no in self.out_of_order:
+            payload = self.out_of_order.pop(self.expected_seq_no)
+            self.out_of_order_bytes -= len(payload)
+            self.expected_seq_no += len(payload)
+            self.callback(self, payload)
+            if self.aborted:
+                return
+
+        # Segments now behind expected_seq_no were retransmitted differently
+        for seq_no in [seq_no for seq_no in self.out_of_order if seq_no < self.expected_seq_no]:
+            self.out_of_order_bytes -= len(self.out_of_order.pop(seq_no))
+
+    def _mss(self):
+        """
+        Effective MSS towards the other end, lowered from MSS when the
+        network layer learned a smaller path MTU.
+        """
+        return min(MSS, self.server.network.path_mtu(self.connection_id[0]) - 40)
 
     def _calculate_inflight_bytes(self):
         if len(self.unacked_segments) == 0:
@@ -188,12 +375,17 @@ class Connection:
         """
         Adds a segment to the sending queue.
         """
+        if self.aborted:
+            return
+
+        self.queued_bytes += len(payload)
 
         # Separates data in 1-MSS packets
-        while len(payload) > MSS:
-            self.sending_queue.append((self.current_seq_no, flags, payload[:MSS]))
-            self.current_seq_no += MSS
-            payload = payload[MSS:]
+        mss = self._mss()
+        while len(payload) > mss:
+            self.sending_queue.append((self.current_seq_no, flags, payload[:mss]))
+            self.current_seq_no += mss
+            payload = payload[mss:]
 
         self.sending_queue.append((self.current_seq_no, flags, payload))
         self.current_seq_no += len(payload)
@@ -203,41 +395,66 @@ class Connection:
         # Tries to send what is in the queue
         self._send_queue()
 
+    @boundary('tcp')
     def _send_queue(self):
-        while len(self.sending_queue) > 0 and \
-            self._calculate_inflight_bytes() + len(self.sending_queue[0][2]) <= self.current_window_size * MSS:
+        if self.syn_sent or self.aborted:
+            return
+        mss = self._mss()
+        while len(self.sending_queue) > 0:
+            inflight_bytes = self._calculate_inflight_bytes()
+            # A segment queued before the MSS was lowered may not fit in the
+            # window on its own, so it is let through when nothing is in flight
+            if inflight_bytes > 0 and \
+                inflight_bytes + len(self.sending_queue[0][2]) > self.current_window_size * mss:
+                break
 
             seq_no, flags, payload = self.sending_queue.pop(0)
+            self.queued_bytes -= len(payload)
 
-            segment = make_header(
-                self.connection_id[3],
-                self.connection_id[1],
-                seq_no,
-                self.expected_seq_no,
-                flags,
-            )
-            segment = segment + payload
-            segment = fix_checksum(
-                segment,
-                self.connection_id[2],
-                self.connection_id[0]
-            )
-
-            self.unacked_segments.append((seq_no, segment, time(), False))
+            segment = self._make_segment(seq_no, flags, payload)
+            self.unacked_segments.append((seq_no, segment, asyncio.get_event_loop().time(), False))
+            segments_sent.inc()
             self.server.network.send(segment, self.connection_id[0])
 
             if self.timer is None:
                 self.timer = asyncio.get_event_loop().call_later(self._timeout_interval(), self._resend_timer)
 
+    def _make_segment(self, seq_no, flags, payload):
+        segment = make_header(
+            self.connection_id[3],
+            self.connection_id[1],
+            seq_no,
+            self.expected_seq_no,
+            flags,
+        )
+        segment = segment + payload
+        return fix_checksum(
+            segment,
+            self.connection_id[2],
+            self.connection_id[0]
+        )
+
     def _resend_timer(self):
+        if self.aborted:
+            return
         if len(self.unacked_segments) > 0:
             # There's been a lost packet! We shall halve the window size
             self.current_window_size = max(1, self.current_window_size // 2)
+            window_sizes.observe(self.current_window_size)
+            retransmissions.inc()
 
             self.server.network.send(self.unacked_segments[0][1], self.connection_id[0])
             self.unacked_segments[0] = (*self.unacked_segments[0][:3], True)
-        
-        self.timer = asyncio.get_event_loop().call_later(self._timeout_interval(), self._resend_timer)
+
+        # Counted from the deadline, so that a late timer doesn't drift, but
+        # from now after the loop stalled, instead of catching up with back
+        # to back retransmissions
+        loop = asyncio.get_event_loop()
+        interval = self._timeout_interval()
+        deadline = self.timer.when() + interval
+        if deadline <= loop.time():
+            deadline = loop.time() + interval
+        self.timer = loop.call_at(deadline, self._resend_timer)
 
     # The methods below are part of the API
 
@@ -252,6 +469,8 @@ class Connection:
         """
         Used by application layer to send data
         """
+        if self.aborted:
+            return
         self._send_segment(
             FLAGS_ACK,
             dados
@@ -265,4 +484,37 @@ class Connection:
         self._send_segment(
             FLAGS_FIN,
             b'',
-        )
\ No newline at end of file
+        )
+
+    def pending_output(self):
+        """
+        Used by application layer to know how much sent data was not
+        acknowledged yet, either queued or in flight, as (bytes, segments).
+        """
+        return self.queued_bytes + self._calculate_inflight_bytes(), \
+            len(self.sending_queue) + len(self.unacked_segments)
+
+    def abort(self, last_words=b''):
+        """
+        Used by application layer to drop the connection at once. Queued and
+        unacknowledged data are discarded, last_words are sent without
+        retransmission and the connection is reset.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # Next sequence number never sent, past any SYN or FIN sent
+        seq_no = self.sending_queue[0][0] if self.sending_queue else self.current_seq_no
+        self.sending_queue = []
+        self.unacked_segments = []
+        self.queued_bytes = 0
+        self.aborted = True
+        connections_aborted.inc()
+
+        if last_words:
+            self.server.network.send(self._make_segment(seq_no, FLAGS_ACK, last_words),
+                                     self.connection_id[0])
+            seq_no += len(last_words)
+        self.server.network.send(self._make_segment(seq_no, FLAGS_RST | FLAGS_ACK, b''),
+                                 self.connection_id[0])
+        self.server.remove_connection(self.connection_id)
@@ -0,0 +1,46 @@
+import struct
+from utils.tcp import calc_checksum
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACH = 3
+ICMP_SOURCE_QUENCH = 4
+ICMP_REDIRECT = 5
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+ICMP_PARAMETER_PROBLEM = 12
+
+# Destination Unreachable codes
+ICMP_NET_UNREACH = 0
+ICMP_HOST_UNREACH = 1
+ICMP_PROT_UNREACH = 2
+ICMP_PORT_UNREACH = 3
+ICMP_FRAG_NEEDED = 4
+
+# Time Exceeded codes
+ICMP_EXC_TTL = 0
+ICMP_EXC_FRAGTIME = 1
+
+# Messages that must never be answered with another ICMP error (RFC 1122)
+ICMP_ERROR_TYPES = frozenset((
+    ICMP_DEST_UNREACH,
+    ICMP_SOURCE_QUENCH,
+    ICMP_REDIRECT,
+    ICMP_TIME_EXCEEDED,
+    ICMP_PARAMETER_PROBLEM,
+))
+
+def make_icmp(type, code, rest, payload=b''):
+    """
+    Construct an ICMP message with a valid checksum. rest is the 32-bit
+    field following the checksum, whose meaning depends on type.
+    """
+    message = struct.pack('!BBHI', type, code, 0, rest) + payload
+    return message[:2] + struct.pack('!H', calc_checksum(message)) + message[4:]
+
+
+def read_icmp_header(message):
+    """
+    Reads an ICMP header.
+    """
+    type, code, checksum, rest = struct.unpack('!BBHI', message[:8])
+    return type, code, checksum, rest, message[8:]
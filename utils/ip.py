@@ -3,6 +3,10 @@ from utils.tcp import addr2str, calc_checksum
 
 IPPROTO_ICMP = 1
 IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+IP_FLAG_MF = 0b001   # More Fragments
+IP_FLAG_DF = 0b010   # Don't Fragment
 
 def read_ipv4_header(datagram, verify_checksum=False):
     # https://en.wikipedia.org/wiki/IPv4#Header
@@ -0,0 +1,85 @@
+MAX_LINE_LENGTH = 512   # Longest message, CRLF included (RFC 1459)
+
+class LineTooLong(Exception):
+    pass
+
+
+class LineBuffer:
+    def __init__(self, max_length=MAX_LINE_LENGTH):
+        """
+        Incremental splitter of a byte stream into CRLF-terminated lines.
+        Received data is appended to a single bytearray and lines are read
+        from an offset, so the buffer is only compacted once per feed.
+        """
+        self.buffer = bytearray()
+        self.offset = 0
+        self.max_length = max_length
+        self.discarding = False
+
+    def feed(self, data):
+        if self.offset > 0:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def pending(self):
+        """
+        Number of buffered bytes not yet returned as lines.
+        """
+        return len(self.buffer) - self.offset
+
+    def has_line(self):
+        """
+        Whether a complete line is buffered.
+        """
+        return self.buffer.find(b'\r\n', self.offset) != -1
+
+    def next_line(self):
+        """
+        Return the next complete line, without its CRLF, or None if there is
+        none yet. Raises LineTooLong once for each line longer than
+        max_length, which is skipped.
+        """
+        while True:
+            end = self.buffer.find(b'\r\n', self.offset)
+            if end == -1:
+                # A CR at the end may be the start of the CRLF
+                keep = 1 if self.buffer.endswith(b'\r') else 0
+                if self.pending() - keep + 2 > self.max_length:
+                    del self.buffer[:len(self.buffer) - keep]
+                    self.offset = 0
+                    if not self.discarding:
+                        self.discarding = True
+                        raise LineTooLong()
+                return None
+
+            start = self.offset
+            self.offset = end + 2
+            if self.discarding:
+                # End of the line that was already reported as too long
+                self.discarding = False
+                continue
+            if self.offset - start > self.max_length:
+                raise LineTooLong()
+            return bytes(self.buffer[start:end])
+
+
+def parse_message(line):
+    """
+    Parse an IRC message into (prefix, command, params) as in RFC 1459.
+    The prefix is None when absent, the command is uppercased and the
+    trailing parameter, if any, is the last one in params. Returns None
+    for empty messages.
+    """
+    prefix = None
+    if line[:1] == b':':
+        prefix, _, line = line[1:].partition(b' ')
+
+    line, separator, trailing = line.partition(b' :')
+    params = line.split()
+    if len(params) == 0:
+        return None
+    if separator:
+        params.append(trailing)
+
+    return prefix, params[0].upper(), params[1:]
@@ -0,0 +1,86 @@
+import sys
+import queue
+import logging
+import logging.handlers
+from time import monotonic
+
+from utils.ratelimit import TokenBucket
+
+LOG_RATE = 5        # Records per second of a single event, on average
+LOG_BURST = 20      # Records of a single event that may be logged back to back
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        """
+        Let through at most rate records per second of each event, an event
+        being identified by its logger and message template. The first
+        record let through after some were dropped tells how many.
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, monotonic)
+
+        if not bucket.consume():
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed > 0:
+            record.msg = '%s (%d similar messages suppressed)' % (record.msg, suppressed)
+        return True
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, every, level=logging.DEBUG):
+        """
+        Keep only one out of every records of each event logged at level
+        or below. Records above level are always kept.
+        """
+        super().__init__()
+        self.every = every
+        self.level = level
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+
+        key = (record.name, record.msg)
+        count = self.counts.get(key, 0)
+        self.counts[key] = (count + 1) % self.every
+        return count == 0
+
+
+def setup_logging(level=logging.INFO, stream=None, rate=LOG_RATE, burst=LOG_BURST,
+                  sample_every=1):
+    """
+    Configure the root logger for the whole stack. Records are filtered
+    and queued by the thread logging them, then formatted and written
+    by a background thread, so logging never blocks on the output.
+    Returns the QueueListener running that thread.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if sample_every > 1:
+        handler.addFilter(SampleFilter(sample_every))
+    handler.addFilter(RateLimitFilter(rate, burst))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return listener
@@ -0,0 +1,210 @@
+import os
+import asyncio
+import weakref
+from bisect import bisect_left
+from time import perf_counter
+
+# Upper bounds, in seconds, of the default latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Gauge:
+    __slots__ = ('value', 'function', 'owner')
+
+    def __init__(self, function=None):
+        """
+        A value that goes up and down. If function is given, the value is
+        whatever it returns when read, and nothing needs to be reported.
+        """
+        self.value = 0
+        self.function = function
+        self.owner = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        if self.owner is not None:
+            owner = self.owner()
+            return self.function(owner) if owner is not None else 0
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Distribution of observed values over fixed buckets, given as
+        increasing upper bounds. Values above the last one fall in an
+        implicit +Inf bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        """
+        Cumulative counts, as {upper bound: observations at most that}.
+        """
+        result = {}
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result[bound] = total
+        return result
+
+
+class Registry:
+    def __init__(self):
+        """
+        Named metrics of the whole stack. Each name is a family of metrics
+        of one type, told apart by their labels. Layers get their metrics
+        once and keep a reference to them, so reporting costs a method call.
+        """
+        # name: (type, help, {labels: metric})
+        self.families = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (cls, help, {})
+        elif family[0] is not cls:
+            raise ValueError(f'metric {name} is already a {family[0].__name__}')
+
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = cls(*args)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, function=None, owner=None, **labels):
+        """
+        If owner is given, function is called with it to read the gauge,
+        and the registry only keeps a weak reference to it. The first
+        owner keeps the gauge as long as it is alive, later ones are
+        ignored: with several stacks in a process (a benchmark, a
+        replay), the one built first is reported.
+        """
+        gauge = self._get(Gauge, name, help, labels)
+        if owner is not None:
+            if gauge.owner is None or gauge.owner() is None:
+                gauge.owner = weakref.ref(owner)
+                gauge.function = function
+        elif function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def snapshot(self):
+        """
+        Current values, as {name: {labels: value}} where labels is a tuple
+        of (label, value) pairs. Histograms are given by get().
+        """
+        return {
+            name: {labels: metric.get() for labels, metric in metrics.items()}
+            for name, (_, _, metrics) in self.families.items()
+        }
+
+    def prometheus(self):
+        """
+        Current values in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, (cls, help, metrics) in sorted(self.families.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {cls.__name__.lower()}')
+            for labels, metric in sorted(metrics.items()):
+                if cls is Histogram:
+                    for bound, count in metric.get().items():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {metric.sum}')
+                    lines.append(f'{name}_count{_labels(labels)} {metric.count}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {metric.get()}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write prometheus() to path, atomically replacing the previous file
+        so that a collector never reads half of it.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temporary, path)
+
+
+REGISTRY = Registry()
+
+def export_periodically(path, interval, registry=REGISTRY):
+    """
+    Write the metrics of registry to path in the Prometheus format now and
+    then every interval seconds, for a node exporter textfile collector.
+    """
+    loop = asyncio.get_event_loop()
+
+    def export():
+        registry.write_prometheus(path)
+        loop.call_later(interval, export)
+
+    export()
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    pairs = ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for label, value in labels)
+    return '{' + pairs + '}'
+
+
+# Time at which the bytes being processed were read from the physical
+# layer. Set by the physical layer around the delivery of what it reads,
+# None when processing did not start from a read (timers, for instance).
+rx_time = None
+
+rx_latency = REGISTRY.histogram(
+    'stack_rx_latency_seconds',
+    'Time from a read on the serial line to the delivery of its data to the application'
+)
+
+def observe_rx_latency():
+    """
+    Called when data is handed to the application.
+    """
+    if rx_time is not None:
+        rx_latency.observe(perf_counter() - rx_time)
@@ -0,0 +1,48 @@
+import asyncio
+
+# Tokens a bucket may be short of and still be considered full enough, for
+# the rounding errors of the refills
+TOLERANCE = 1e-9
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=None):
+        """
+        Token bucket refilled with rate tokens per second, holding at most
+        burst tokens. Starts full. Time is read from clock, the event loop
+        clock by default.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = None
+        self.clock = clock
+
+    def _refill(self):
+        if self.clock is None:
+            now = asyncio.get_event_loop().time()
+        else:
+            now = self.clock()
+        if self.last_refill is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount=1):
+        """
+        Take amount tokens from the bucket. Returns False, taking nothing,
+        if there are not enough tokens.
+        """
+        self._refill()
+        if self.tokens < amount - TOLERANCE:
+            return False
+
+        self.tokens -= amount
+        return True
+
+    def delay(self, amount=1):
+        """
+        Seconds until amount tokens will be available.
+        """
+        self._refill()
+        if self.tokens >= amount - TOLERANCE:
+            return 0
+        return (amount - self.tokens) / self.rate
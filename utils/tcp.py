@@ -1,4 +1,5 @@
 import struct
+from functools import lru_cache
 
 FLAGS_FIN = 1<<0
 FLAGS_SYN = 1<<1
@@ -81,4 +82,20 @@ def str2addr(addr):
     """
     Convert a 'x.y.z.w' to a binary IPv4.
     """
-    return bytes(int(x) for x in addr.split('.'))
\ No newline at end of file
+    return bytes(int(x) for x in addr.split('.'))
+
+
+@lru_cache(maxsize=1024)
+def str2int(addr):
+    """
+    Convert a 'x.y.z.w' string to a 32-bit integer.
+    """
+    return int.from_bytes(str2addr(addr), 'big')
+
+
+def flow_key(src_addr, src_port, dst_addr, dst_port):
+    """
+    Pack a connection 4-tuple into a single integer, suitable as a
+    dictionary key. IPv4 addresses must be passed as 'x.y.z.w' strings.
+    """
+    return (((str2int(src_addr) << 16 | src_port) << 32) | str2int(dst_addr)) << 16 | dst_port
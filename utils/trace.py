@@ -0,0 +1,139 @@
+import os
+import json
+from collections import deque
+from time import perf_counter_ns, thread_time_ns
+
+# Tracing of the calls crossing the layer boundaries of the stack.
+#
+# Boundary methods are marked with the boundary decorator, which leaves
+# them untouched: with tracing off they cost nothing at all. enable()
+# replaces them with wrappers timing every call. Since the layers keep
+# references to each other's methods as callbacks, it has to be called
+# before the stack is built.
+#
+# For every traced call, the wrappers record a Chrome trace event (kept in
+# a ring of the most recent ones) and the CPU time spent in the method
+# itself, traced callees excluded, both per layer and per call stack.
+
+TRACE_EVENTS = 100000   # Most recent calls kept for the Chrome trace
+
+_hooks = []             # (owner class, attribute, function, layer)
+_enabled = False
+_events = deque(maxlen=TRACE_EVENTS)
+_layers = {}            # layer: [calls, self CPU time in ns]
+_stacks = {}            # 'name;name;...': self CPU time in ns
+_names = []             # Names of the traced calls in progress
+_children = []          # CPU time in ns of the traced callees of each of them
+_start = perf_counter_ns()
+
+class _Boundary:
+    def __init__(self, layer, function):
+        self.layer = layer
+        self.function = function
+
+    def __set_name__(self, owner, name):
+        _hooks.append((owner, name, self.function, self.layer))
+        setattr(owner, name, self.function)
+        if _enabled:
+            _install(owner, name, self.function, self.layer)
+
+
+def boundary(layer):
+    """
+    Mark a method as the entry of layer, to be traced once enabled.
+    """
+    def decorate(function):
+        return _Boundary(layer, function)
+    return decorate
+
+
+def _install(owner, attribute, function, layer):
+    name = f'{owner.__name__}.{function.__name__}'
+    counts = _layers.setdefault(layer, [0, 0])
+
+    def traced(*args, **kwargs):
+        _names.append(name)
+        _children.append(0)
+        wall = perf_counter_ns()
+        cpu = thread_time_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            cpu = thread_time_ns() - cpu
+            duration = perf_counter_ns() - wall
+            self_cpu = cpu - _children.pop()
+            if _children:
+                _children[-1] += cpu
+
+            stack = ';'.join(_names)
+            _names.pop()
+            counts[0] += 1
+            counts[1] += self_cpu
+            _stacks[stack] = _stacks.get(stack, 0) + self_cpu
+            _events.append((name, layer, wall, duration))
+
+    traced.__wrapped__ = function
+    setattr(owner, attribute, traced)
+
+
+def enable(events=TRACE_EVENTS):
+    """
+    Start tracing the boundary methods, keeping the last events calls for
+    the Chrome trace. Objects built before keep calling the untraced ones.
+    """
+    global _enabled, _events
+    _events = deque(_events, maxlen=events)
+    if not _enabled:
+        _enabled = True
+        for hook in _hooks:
+            _install(*hook)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    for owner, attribute, function, _ in _hooks:
+        setattr(owner, attribute, function)
+
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+    _events.clear()
+    _stacks.clear()
+    for counts in _layers.values():
+        counts[0] = counts[1] = 0
+
+
+def layer_times():
+    """
+    CPU time spent in each layer, as {layer: (calls, seconds)}. The time
+    of a call excludes the traced calls made from it.
+    """
+    return {layer: (calls, cpu / 1e9) for layer, (calls, cpu) in _layers.items()}
+
+
+def write_chrome_trace(path):
+    """
+    Write the recorded calls in the Chrome trace event format, to be
+    opened with chrome://tracing or Perfetto.
+    """
+    pid = os.getpid()
+    events = [
+        {'name': name, 'cat': layer, 'ph': 'X', 'pid': pid, 'tid': 0,
+         'ts': (wall - _start) / 1000, 'dur': duration / 1000}
+        for name, layer, wall, duration in _events
+    ]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
+
+
+def write_folded(path):
+    """
+    Write the CPU time of every call stack, in microseconds, as folded
+    stacks for flamegraph.pl or speedscope.
+    """
+    with open(path, 'w') as f:
+        for stack, cpu in sorted(_stacks.items()):
+            f.write(f'{stack} {cpu // 1000}\n')